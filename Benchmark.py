@@ -0,0 +1,720 @@
+import Settings
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEBUG = False
+MSG_PREFIX = 'Message from Benchmark >> '
+
+# End-to-end benchmark of an overdue run without MYOB or SQL Server:
+# > python Benchmark.py --invoices 50000 --customers 5000 --latency 0.05
+# > MYOB is replaced by a local OData server (MyobStandIn) serving invoices
+#   made by InvoiceData, and Syrinx by an in-memory SQLite TH_CUSTOMERS
+#   (SyrinxStandIn)
+# > Each stage is timed and the results appended to benchmarks.jsonl. Stages
+#   slower than the last run with the same settings are reported.
+# > python Benchmark.py --check-kept-notes: runs the server-side clear over
+#   the alert texts in KEPT_NOTES_CASES and compares it with kept_notes()
+
+config = Settings.config
+curpath = Settings.curpath
+
+# Stages timed by run_benchmark, in the order they run
+STAGES = ['myob_request', 'load_snapshot', 'syrinx_clear', 'get_overdue',
+          'set_overdue', 'convert_log_to_excel']
+
+# Share of customers given an automated alert and on hold flag, a manual
+# alert only, or the HoldOverdue (exclude) property in TH_CUSTOMERS
+FLAGGED_SHARE = 0.2
+NOTED_SHARE = 0.05
+EXCLUDED_SHARE = 0.05
+
+# Alert texts that the server-side clear must split as kept_notes() does:
+# the '~~' marker at the start, at the end, alone, twice or missing, with
+# and without trailing spaces, and no alert at all. test_kept_notes.py
+# checks them against the stand-in; SetOverdue.check_server_clear is the
+# check against the live T-SQL on Syrinx
+KEPT_NOTES_CASES = ['ON HOLD ~~ Call before delivery',
+                    '~~ note',
+                    '~~',
+                    'ON HOLD ~~',
+                    'ON HOLD ~~ ',
+                    'ON HOLD ~~ note  ',
+                    'ON HOLD ~~    ',
+                    'ON HOLD ~~note',
+                    'A~~B',
+                    'ON HOLD ~~ one ~~ two',
+                    ' ~~ note',
+                    'Deliver to back door',
+                    'Deliver to back door  ',
+                    '~',
+                    '',
+                    None]
+
+
+class InvoiceData:
+    """
+    Synthetic Sale/Invoice data for a number of invoices spread across a
+    number of customers. Only compact NumPy columns are held; each invoice
+    is built as a MYOB JSON item when it is served. The same seed always
+    gives the same invoices.
+    """
+
+    terms_days = 30
+
+    def __init__(self, invoices, customers, seed=0, today=None):
+        import numpy as np
+
+        if today is None:
+            today = datetime.date.today()
+        rng = np.random.default_rng(seed)
+        self.customers = customers
+        self.customer = rng.integers(0, customers, invoices)
+        self.date = today.toordinal() - rng.integers(0, 365, invoices)
+        self.due = self.date + self.terms_days
+        self.total = np.round(rng.uniform(10, 5000, invoices), 2)
+
+        # 40% paid, 20% part paid, the rest still owing in full
+        state = rng.random(invoices)
+        self.balance = np.where(state < 0.4, 0.0, self.total)
+        part_paid = (state >= 0.4) & (state < 0.6)
+        self.balance[part_paid] = np.round(self.total[part_paid] / 2, 2)
+
+    def __len__(self):
+        return len(self.customer)
+
+    def matching(self, balance_gt=None, due_le=None, display_ids=None):
+        """
+        Returns the index of every invoice with a balance greater than
+        balance_gt and a due date on or before the date due_le, for the
+        customers in display_ids if given.
+        """
+        import numpy as np
+
+        selected = np.ones(len(self), dtype=bool)
+        if balance_gt is not None:
+            selected &= self.balance > balance_gt
+        if due_le is not None:
+            selected &= self.due <= due_le.toordinal()
+        if display_ids:
+            codes = [int(display_id[1:]) for display_id in display_ids
+                     if re.fullmatch(r'C\d+', display_id)]
+            selected &= np.isin(self.customer, codes)
+        return np.flatnonzero(selected)
+
+    def item(self, i):
+        """
+        Returns invoice i as MYOB returns it from Sale/Invoice.
+        """
+        date = datetime.date.fromordinal(int(self.date[i])).isoformat()
+        due = datetime.date.fromordinal(int(self.due[i])).isoformat()
+        total = float(self.total[i])
+        subtotal = round(total / 1.1, 2)
+        code = int(self.customer[i])
+        return {'UID': f'00000000-0000-0000-0000-{i:012d}',
+                'Number': f'{i + 1:08d}',
+                'Date': date + 'T00:00:00',
+                'Customer': {'DisplayID': display_id(code),
+                             'Name': f'Customer {code}'},
+                'BalanceDueAmount': float(self.balance[i]),
+                'Subtotal': subtotal,
+                'TotalTax': round(total - subtotal, 2),
+                'TotalAmount': total,
+                'JournalMemo': f'Sale; Customer {code}',
+                'Terms': {'DueDate': due + 'T00:00:00'},
+                'LastModified': date + 'T12:00:00'}
+
+
+class MyobStandIn:
+    """
+    Local HTTP server answering AccountRight Sale/Invoice queries from an
+    InvoiceData. The BalanceDueAmount gt, Terms/DueDate le and
+    Customer/DisplayID eq filters of the overdue query are applied, and
+    results are paged like MYOB with Items,
+    NextPageLink and Count, honouring $top and $skip. Every response waits
+    latency seconds first, and requests beyond throttle per second (0 for no
+    limit) get a 429 with Retry-After.
+    """
+
+    def __init__(self, data, latency=0.0, throttle=0, page_size=400):
+        self.data = data
+        self.latency = latency
+        self.throttle = throttle
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.filters = dict()
+        self.window = 0
+        self.window_requests = 0
+        self.requests = 0
+        self.throttled = 0
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MyobHandler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.url = 'http://127.0.0.1:%d/accountright/' \
+                   % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def allow(self):
+        """
+        Counts a request and returns False if it is over the throttle.
+        """
+        with self.lock:
+            self.requests += 1
+            if not self.throttle:
+                return True
+            second = int(time.monotonic())
+            if second != self.window:
+                self.window = second
+                self.window_requests = 0
+            self.window_requests += 1
+            if self.window_requests > self.throttle:
+                self.throttled += 1
+                return False
+            return True
+
+    def matching(self, odata_filter):
+        """
+        Returns the invoices matching an OData $filter, caching the result
+        for the later pages of the same query.
+        """
+        with self.lock:
+            found = self.filters.get(odata_filter)
+        if found is None:
+            balance = re.search(r'BalanceDueAmount gt ([\d.]+)M',
+                                odata_filter)
+            due = re.search(r"Terms/DueDate le datetime'(\d{4}-\d\d-\d\d)",
+                            odata_filter)
+            display_ids = [value.replace("''", "'") for value in
+                           re.findall(r"Customer/DisplayID eq '((?:[^']|'')*)'",
+                                      odata_filter)]
+            found = self.data.matching(
+                float(balance.group(1)) if balance else None,
+                datetime.date.fromisoformat(due.group(1)) if due else None,
+                display_ids)
+            with self.lock:
+                self.filters[odata_filter] = found
+        return found
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MyobHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.rstrip('/').endswith('Sale/Invoice'):
+            self.send_json(404, {'Errors': [{'Name': 'NotFound'}]})
+            return
+        if not stand_in.allow():
+            self.send_json(429, {'Errors': [{'Name': 'RateLimitError'}]},
+                           {'Retry-After': '1'})
+            return
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+
+        query = dict(urllib.parse.parse_qsl(url.query))
+        found = stand_in.matching(query.get('$filter', ''))
+        top = min(int(query.get('$top', stand_in.page_size)), 1000)
+        skip = int(query.get('$skip', 0))
+
+        next_link = None
+        if skip + top < len(found):
+            query.update({'$top': top, '$skip': skip + top})
+            next_link = urllib.parse.urlunsplit(
+                ('http', self.headers['Host'], url.path,
+                 urllib.parse.urlencode(query), ''))
+        self.send_json(200, {'Items': [stand_in.data.item(int(i))
+                                       for i in found[skip:skip + top]],
+                             'NextPageLink': next_link,
+                             'Count': len(found)})
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if DEBUG:
+            super().log_message(format, *args)
+
+
+class SyrinxStandIn:
+    """
+    In-memory SQLite copy of the TH_CUSTOMERS columns used by SetOverdue,
+    reached through a pyodbc-like connection (see connect). The T-SQL in
+    SetOverdue is run as is where SQLite accepts it once the database prefix
+    and temporary table marker are dropped; the statements that need T-SQL
+    syntax have SQLite equivalents in translations.
+    """
+
+    def __init__(self):
+        import SetOverdue
+
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.create_function('CHARINDEX', 2, charindex)
+        self.db.create_function('STUFF', 4, stuff)
+        self.db.create_function('DATALENGTH', 1, datalength)
+        self.db.create_function('GETDATE', 0, getdate)
+        self.db.execute('CREATE TABLE TH_CUSTOMERS ('
+                        'CST_ACCOUNT_NUMBER TEXT, '
+                        'CST_CURRENT_FLAG INTEGER NOT NULL DEFAULT 1, '
+                        'CST_ALERT_TEXT TEXT, '
+                        'CST_ALERT_CHG_DATE TEXT, '
+                        'CST_ALERT_CHG_USERID INTEGER, '
+                        'CST_ON_HOLD INTEGER NOT NULL DEFAULT 0, '
+                        'CST_PROP2 TEXT)')
+        self.db.execute('CREATE INDEX TH_CUSTOMERS_ACCOUNT '
+                        'ON TH_CUSTOMERS (CST_ACCOUNT_NUMBER)')
+
+        self.translations = {
+            SetOverdue.SQL_CREATE_STAGING: [
+                'DROP TABLE IF EXISTS temp.OVERDUE_STATE',
+                'CREATE TEMP TABLE OVERDUE_STATE ('
+                'CST_ACCOUNT_NUMBER TEXT NOT NULL, '
+                'CST_ALERT_TEXT TEXT NULL, '
+                'CST_ON_HOLD INTEGER NULL, '
+                'ALERT_STAMPED INTEGER NOT NULL)'],
+            SetOverdue.SQL_APPLY_STAGING: [
+                'UPDATE TH_CUSTOMERS AS c SET '
+                'CST_ALERT_CHG_DATE = CASE WHEN s.ALERT_STAMPED = 1 '
+                'THEN GETDATE() ELSE NULL END, '
+                'CST_ALERT_CHG_USERID = CASE WHEN s.ALERT_STAMPED = 1 '
+                'THEN 16 ELSE NULL END, '
+                'CST_ALERT_TEXT = s.CST_ALERT_TEXT, '
+                'CST_ON_HOLD = COALESCE(s.CST_ON_HOLD, c.CST_ON_HOLD) '
+                'FROM OVERDUE_STATE AS s '
+                'WHERE c.CST_ACCOUNT_NUMBER = s.CST_ACCOUNT_NUMBER'],
+            SetOverdue.SQL_CLEAR_FLAGGED: [
+                'UPDATE TH_CUSTOMERS AS c SET '
+                'CST_ALERT_CHG_DATE = NULL, '
+                'CST_ALERT_CHG_USERID = NULL, '
+                'CST_ALERT_TEXT = CASE WHEN DATALENGTH(f.KEPT_NOTES) = 0 '
+                'THEN NULL ELSE f.KEPT_NOTES END, '
+                'CST_ON_HOLD = 0 '
+                'FROM (' + self.rewrite(SetOverdue.SQL_SELECT_KEPT_NOTES)
+                + ') AS f '
+                'WHERE c.CST_ACCOUNT_NUMBER = f.CST_ACCOUNT_NUMBER']}
+
+    def rewrite(self, sql):
+        return sql.replace('SyrinxEH.dbo.', '').replace('#OVERDUE_STATE',
+                                                        'OVERDUE_STATE')
+
+    def translate(self, sql):
+        """
+        Returns the SQLite statements to run for a SetOverdue statement.
+        """
+        return self.translations.get(sql) or [self.rewrite(sql)]
+
+    def populate(self, customers, seed=0):
+        """
+        Adds a customer for each account in InvoiceData, flagging a share of
+        them as a previous run would have, plus as many again that never
+        appear in MYOB.
+        """
+        import random
+
+        rng = random.Random(seed)
+        alert = ('ON HOLD DUE TO OVERDUE ACCOUNT: $100.00 to be paid '
+                 'immediately. ~~ ')
+        rows = list()
+        for code in range(customers * 2):
+            account = display_id(code) if code < customers \
+                else f'S{code:06d}'
+            draw = rng.random()
+            if draw < FLAGGED_SHARE:
+                rows.append((account, alert + 'Call before delivery', 1, None))
+            elif draw < FLAGGED_SHARE + NOTED_SHARE:
+                rows.append((account, 'Deliver to back door', 0, None))
+            elif draw < FLAGGED_SHARE + NOTED_SHARE + EXCLUDED_SHARE:
+                rows.append((account, None, 0, 'N'))
+            else:
+                rows.append((account, None, 0, None))
+        self.db.executemany('INSERT INTO TH_CUSTOMERS (CST_ACCOUNT_NUMBER, '
+                            'CST_ALERT_TEXT, CST_ON_HOLD, CST_PROP2) '
+                            'VALUES (?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def counts(self):
+        """
+        Returns the number of customers with an alert and on hold.
+        """
+        return dict(zip(['alerts', 'on_hold'], self.db.execute(
+            'SELECT COUNT(CST_ALERT_TEXT), SUM(CST_ON_HOLD) '
+            'FROM TH_CUSTOMERS').fetchone()))
+
+    def connect(self):
+        return StandInConnection(self)
+
+
+class StandInConnection:
+    """
+    The parts of a pyodbc connection used by SetOverdue.
+    """
+
+    def __init__(self, syrinx):
+        self.syrinx = syrinx
+
+    def cursor(self):
+        return StandInCursor(self.syrinx)
+
+    def commit(self):
+        self.syrinx.db.commit()
+
+    def rollback(self):
+        self.syrinx.db.rollback()
+
+    def close(self):
+        pass
+
+
+class StandInCursor:
+    """
+    The parts of a pyodbc cursor used by SetOverdue, running each statement
+    through SyrinxStandIn.translate.
+    """
+
+    def __init__(self, syrinx):
+        self.syrinx = syrinx
+        self.cursor = syrinx.db.cursor()
+        self.fast_executemany = False
+        self.rowcount = -1
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        for statement in self.syrinx.translate(sql):
+            self.cursor.execute(statement, params)
+        self.rowcount = self.cursor.rowcount
+        return self
+
+    def executemany(self, sql, rows):
+        for statement in self.syrinx.translate(sql):
+            self.cursor.executemany(statement, rows)
+        self.rowcount = self.cursor.rowcount
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def charindex(find, text):
+    if find is None or text is None:
+        return None
+    return text.find(find) + 1
+
+
+def stuff(text, start, length, insert):
+    # As in T-SQL, a start outside the text or a negative length gives NULL
+    if text is None or start < 1 or start > len(text) or length < 0:
+        return None
+    return text[0:start - 1] + (insert or '') + text[start - 1 + length:]
+
+
+def datalength(text):
+    if text is None:
+        return None
+    # NVARCHAR, two bytes a character
+    return len(text) * 2
+
+
+def getdate():
+    return datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+
+
+def display_id(code):
+    return f'C{code:06d}'
+
+
+class Stopwatch:
+    """
+    Records the seconds taken by each named stage: with watch('stage'): ...
+    """
+
+    def __init__(self):
+        self.seconds = dict()
+        self.name = None
+        self.started = None
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        self.seconds[self.name] = round(elapsed, 4)
+        print(MSG_PREFIX + f'{self.name}: {elapsed:.3f}s')
+
+
+def use_folder(folder, rate=None):
+    """
+    Points the log folder of every module at folder, writes only the TSV
+    logs through the pipeline so the Excel log is timed on its own, and
+    keeps the snapshot from overwriting the one saved by real runs. rate
+    overrides the [HTTP] requests per second.
+    """
+    import MyobAuth
+    import SetOverdue
+
+    folder = os.path.join(folder, '')
+    os.makedirs(folder, exist_ok=True)
+    SetOverdue.folder_location = folder
+    config.read_dict({'DEFAULT': {'folder_location': folder},
+                      'LOGS': {'sinks': 'tsv'},
+                      'SNAPSHOT': {'path': ''},
+                      'MYOB': {'file_id': '', 'company_files': ''}})
+    if rate is not None:
+        config.read_dict({'HTTP': {'rate_per_second': str(rate),
+                                   'burst': str(rate)}})
+        MyobAuth.EagleMyobApi.scheduler = None
+
+
+def run_benchmark(invoices, customers, days_over=60, min_total=0.0,
+                  buckets=(30, 60, 90, 120), parallel=True, server_side=False,
+                  latency=0.0, throttle=0, page_size=400, rate=None, seed=0,
+                  folder=None):
+    """
+    Runs every stage of an overdue run against the stand-ins and returns a
+    record of the settings, the seconds taken by each stage and the number
+    of invoices and customers handled.
+    """
+    import OverdueLog
+    import SetOverdue
+
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix='overdue-benchmark-')
+    use_folder(folder, rate)
+    params = {'invoices': invoices, 'customers': customers,
+              'days_over': days_over, 'min_total': min_total,
+              'buckets': list(buckets), 'parallel': parallel,
+              'server_side': server_side, 'latency': latency,
+              'throttle': throttle, 'page_size': page_size, 'rate': rate,
+              'seed': seed}
+
+    data = InvoiceData(invoices, customers, seed)
+    myob = MyobStandIn(data, latency, throttle, page_size)
+    syrinx = SyrinxStandIn()
+    syrinx.populate(customers, seed)
+
+    context = SetOverdue.context
+    context.close()
+    context.attach(syrinx.connect())
+    context.app.api_url = myob.url
+    context.app.tokens.access_token = 'benchmark'
+    context.app.tokens.expires_at = float('inf')
+
+    watch = Stopwatch()
+    try:
+        with watch('myob_request'):
+            fetched = context.app.myob_request('overdue', min_total,
+                                               min([days_over]
+                                                   + list(buckets)),
+                                               parallel)
+        with watch('load_snapshot'):
+            snapshot = SetOverdue.load_snapshot()
+        with watch('syrinx_clear'):
+            SetOverdue.syrinx_clear(snapshot, server_side)
+        with watch('get_overdue'):
+            overdue = SetOverdue.get_overdue(days_over, min_total,
+                                             parallel=parallel,
+                                             snapshot=snapshot,
+                                             buckets=list(buckets))
+        with watch('set_overdue'):
+            SetOverdue.set_overdue(overdue[0], days_over, overdue[2],
+                                   close=False)
+        stamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        with watch('convert_log_to_excel'):
+            OverdueLog.convert_log_to_excel(overdue[0], overdue[1], stamp,
+                                            email=False)
+    finally:
+        context.close()
+        myob.close()
+
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'params': params,
+            'stages': watch.seconds,
+            'total': round(sum(watch.seconds.values()), 4),
+            'counts': dict({'fetched': len(fetched or []),
+                            'invoices': len(overdue[1]),
+                            'customers': len(overdue[0]),
+                            'requests': myob.requests,
+                            'throttled': myob.throttled},
+                           **syrinx.counts()),
+            'python': sys.version.split()[0]}
+
+
+def check_kept_notes(cases=None):
+    """
+    Loads each alert text in cases (default KEPT_NOTES_CASES) into a
+    SyrinxStandIn as a flagged customer, then runs SetOverdue's server-side
+    clear over them: first SQL_KEPT_NOTES through check_server_clear, then
+    SQL_CLEAR_FLAGGED itself. Returns (alert text, SQL result, Python result)
+    for every case where the alert left by the SQL differs from kept_notes().
+    """
+    import SetOverdue
+
+    if cases is None:
+        cases = KEPT_NOTES_CASES
+    syrinx = SyrinxStandIn()
+    accounts = {f'K{i:06d}': text for i, text in enumerate(cases)}
+    syrinx.db.executemany('INSERT INTO TH_CUSTOMERS (CST_ACCOUNT_NUMBER, '
+                          'CST_ALERT_TEXT, CST_ON_HOLD) VALUES (?, ?, 1)',
+                          accounts.items())
+    syrinx.db.commit()
+
+    context = SetOverdue.context
+    context.close()
+    context.attach(syrinx.connect())
+    try:
+        mismatches = [(row[1], row[2], row[3])
+                      for row in SetOverdue.check_server_clear()]
+        context.cursor.execute(SetOverdue.SQL_CLEAR_FLAGGED)
+        context.connection.commit()
+    finally:
+        context.close()
+
+    cleared = dict(syrinx.db.execute('SELECT CST_ACCOUNT_NUMBER, '
+                                     'CST_ALERT_TEXT FROM TH_CUSTOMERS'))
+    for account, text in accounts.items():
+        expected = SetOverdue.kept_notes(text) or None
+        if cleared[account] != expected:
+            mismatches.append((text, cleared[account], expected))
+    return mismatches
+
+
+def last_record(path, params):
+    """
+    Returns the latest record in the results file with the same settings,
+    or None.
+    """
+    previous = None
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('params') == params:
+                previous = record
+    return previous
+
+
+def regressions(previous, record, tolerance=0.2, minimum=0.05):
+    """
+    Returns (stage, previous seconds, seconds) for each stage more than
+    tolerance slower than in the previous record. Stages faster than minimum
+    seconds both times are ignored as noise.
+    """
+    slower = list()
+    for stage in STAGES:
+        before = previous['stages'].get(stage)
+        after = record['stages'].get(stage)
+        if before is None or after is None:
+            continue
+        if max(before, after) >= minimum and after > before * (1 + tolerance):
+            slower.append((stage, before, after))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Times each stage of an overdue run against a local '
+                    'MYOB stand-in and an in-memory Syrinx.')
+    parser.add_argument('--invoices', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--days-over', type=int, default=60)
+    parser.add_argument('--sequential', action='store_true',
+                        help='follow NextPageLink instead of fetching pages '
+                             'concurrently')
+    parser.add_argument('--server-side', action='store_true',
+                        help='clear alert notes with one server-side UPDATE')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stand-in waits before each response')
+    parser.add_argument('--throttle', type=int, default=0,
+                        help='requests per second served before 429s '
+                             '(0 for no limit)')
+    parser.add_argument('--page-size', type=int, default=400)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='override the [HTTP] rate_per_second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folder', default=None,
+                        help='folder for the logs (default a new temporary '
+                             'folder)')
+    parser.add_argument('--output',
+                        default=os.path.join(curpath, 'benchmarks.jsonl'),
+                        help='JSON Lines file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown against the last matching run that '
+                             'counts as a regression')
+    parser.add_argument('--check-kept-notes', action='store_true',
+                        help='only check the server-side clear keeps the '
+                             'same notes as kept_notes()')
+    args = parser.parse_args(argv)
+
+    if args.check_kept_notes:
+        mismatches = check_kept_notes()
+        for text, server, expected in mismatches:
+            print(MSG_PREFIX + f'Kept notes of {text!r}: SQL {server!r}, '
+                               f'kept_notes() {expected!r}')
+        print(MSG_PREFIX + f'{len(KEPT_NOTES_CASES)} alert texts checked, '
+                           f'{len(mismatches)} mismatches.')
+        return 1 if mismatches else 0
+
+    record = run_benchmark(args.invoices, args.customers, args.days_over,
+                           parallel=not args.sequential,
+                           server_side=args.server_side,
+                           latency=args.latency, throttle=args.throttle,
+                           page_size=args.page_size, rate=args.rate,
+                           seed=args.seed, folder=args.folder)
+
+    previous = last_record(args.output, record['params'])
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+    print(MSG_PREFIX + f"{record['total']:.3f}s in total, results added to "
+                       f"{args.output}")
+    if previous is None:
+        return 0
+    slower = regressions(previous, record, args.tolerance)
+    for stage, before, after in slower:
+        print(MSG_PREFIX + f'{stage} regressed: {before:.3f}s -> '
+                           f'{after:.3f}s')
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
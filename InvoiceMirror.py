@@ -0,0 +1,150 @@
+import MyobAuth
+import Settings
+import datetime
+import os
+import sqlite3
+
+DEBUG = False
+MSG_PREFIX = 'Message from InvoiceMirror >> '
+
+# Local SQLite copy of MYOB Sale/Invoice rows:
+# > Bring the mirror up to date: InvoiceMirror().sync(app)
+# > Query overdue invoices: InvoiceMirror().overdue(days_over, min_total)
+
+config = Settings.config
+curpath = Settings.curpath
+
+# Invoice fields stored in the mirror
+MIRROR_SELECT = MyobAuth.OVERDUE_SELECT + ['UID', 'LastModified']
+
+
+class InvoiceMirror:
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(curpath, config.get('MIRROR', 'path',
+                                                    fallback='invoices.db'))
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS invoices ('
+                        'file_id TEXT NOT NULL, '
+                        'uid TEXT NOT NULL, '
+                        'number TEXT, '
+                        'date TEXT, '
+                        'due_date TEXT, '
+                        'display_id TEXT, '
+                        'name TEXT, '
+                        'balance REAL, '
+                        'subtotal REAL, '
+                        'tax REAL, '
+                        'total REAL, '
+                        'memo TEXT, '
+                        'last_modified TEXT, '
+                        'PRIMARY KEY (file_id, uid))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS invoices_overdue '
+                        'ON invoices (file_id, due_date, balance)')
+        self.db.commit()
+
+    def high_water_mark(self, file_id=''):
+        """
+        Returns the newest LastModified value stored for the company file, or
+        None if the mirror holds no invoices for it yet.
+        """
+        row = self.db.execute('SELECT MAX(last_modified) FROM invoices '
+                              'WHERE file_id = ?', (file_id,)).fetchone()
+        return row[0]
+
+    def sync(self, app, file_id=None, parallel=False, full=False):
+        """
+        Fetches invoices changed since the high-water mark and stores them in
+        the mirror. The first sync, or a full one, fetches every invoice with
+        an outstanding balance. Pages are committed as they arrive, so an
+        interrupted sync resumes from where it stopped. Invoices deleted in
+        MYOB are only removed by a full sync.
+        """
+        if file_id is None:
+            file_id = config.get('MYOB', 'file_id', fallback='')
+
+        if full:
+            self.db.execute('DELETE FROM invoices WHERE file_id = ?',
+                            (file_id,))
+            self.db.commit()
+
+        mark = self.high_water_mark(file_id)
+        if mark is None:
+            filters = ['BalanceDueAmount gt 0M']
+        else:
+            filters = [f"LastModified ge datetime'{mark}'"]
+
+        url = app.build_query('Sale/Invoice', file_id, filters=filters,
+                              select=MIRROR_SELECT, orderby=['LastModified'])
+
+        synced = 0
+        for page in app.iter_pages(url, parallel=parallel):
+            self.db.executemany('INSERT OR REPLACE INTO invoices VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [to_row(file_id, item) for item in page])
+            self.db.commit()
+            synced += len(page)
+
+        print(MSG_PREFIX + f'{synced} invoices synced since '
+                           f'{mark or "the start"}.')
+        return synced
+
+    def overdue(self, days_over=60, min_total=0.0, file_id=None):
+        """
+        Yields invoices with a balance greater than min_total that fell due
+        before the current date less days_over, in the same shape as the items
+        returned by the MYOB overdue query.
+        """
+        if file_id is None:
+            file_id = config.get('MYOB', 'file_id', fallback='')
+
+        d = datetime.date.today() - datetime.timedelta(days=days_over)
+        rows = self.db.execute('SELECT number, date, display_id, name, '
+                               'balance, subtotal, tax, total, memo, due_date '
+                               'FROM invoices '
+                               'WHERE file_id = ? AND balance > ? '
+                               'AND due_date <= ? '
+                               'ORDER BY number',
+                               (file_id, min_total, d.isoformat()))
+        for row in rows:
+            yield from_row(row)
+
+    def close(self):
+        self.db.close()
+
+
+def to_row(file_id, item):
+    """
+    Converts a MYOB invoice into a row of the invoices table.
+    """
+    return (file_id,
+            item['UID'],
+            item['Number'],
+            item['Date'],
+            # Only the date part is kept so it compares with ISO dates
+            item['Terms']['DueDate'][0:10],
+            item['Customer']['DisplayID'],
+            item['Customer']['Name'],
+            item['BalanceDueAmount'],
+            item['Subtotal'],
+            item['TotalTax'],
+            item['TotalAmount'],
+            item['JournalMemo'],
+            item['LastModified'])
+
+
+def from_row(row):
+    """
+    Converts a row selected by InvoiceMirror.overdue back into a MYOB invoice.
+    """
+    return {'Number': row[0],
+            'Date': row[1],
+            'Customer': {'DisplayID': row[2], 'Name': row[3]},
+            'BalanceDueAmount': row[4],
+            'Subtotal': row[5],
+            'TotalTax': row[6],
+            'TotalAmount': row[7],
+            'JournalMemo': row[8],
+            'Terms': {'DueDate': row[9]}}
@@ -0,0 +1,208 @@
+import array
+import datetime
+import numpy as np
+
+DEBUG = False
+MSG_PREFIX = 'Message from InvoiceTable >> '
+
+# Ordinal of 1970-01-01, the NumPy datetime64 epoch
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+class InvoiceTable:
+    """
+    Columnar table of MYOB invoices. Invoices are appended one at a time as
+    they stream in from MYOB and stored in compact typed columns; finish()
+    turns the columns into NumPy arrays so per-customer figures can be worked
+    out with vectorised group-bys. Customers are stored once and referred to
+    by an integer customer code. Each invoice also keeps the integer code of
+    its source, such as the company file it came from.
+    """
+
+    def __init__(self):
+        # Customer code -> DisplayID and Name
+        self.customers = list()
+        self.names = list()
+        self._codes = dict()
+
+        # Text columns
+        self.number = list()
+        self.memo = list()
+
+        # Typed columns, dates held as days since 1970-01-01
+        self._date = array.array('q')
+        self._due_date = array.array('q')
+        self._code = array.array('q')
+        self._source = array.array('q')
+        self._balance = array.array('d')
+        self._subtotal = array.array('d')
+        self._tax = array.array('d')
+        self._total = array.array('d')
+
+        self.date = None
+        self.due_date = None
+        self.code = None
+        self.source = None
+        self.balance = None
+        self.subtotal = None
+        self.tax = None
+        self.total = None
+
+    def add(self, invoice, source=0):
+        """
+        Appends a MYOB invoice from the given source and returns its customer
+        code.
+        """
+        display_id = invoice['Customer']['DisplayID']
+        code = self._codes.get(display_id)
+        if code is None:
+            code = len(self.customers)
+            self._codes[display_id] = code
+            self.customers.append(display_id)
+            self.names.append(invoice['Customer']['Name'])
+
+        self.number.append(invoice['Number'])
+        self.memo.append(invoice['JournalMemo'])
+        self._date.append(day_number(invoice['Date']))
+        self._due_date.append(day_number(invoice['Terms']['DueDate']))
+        self._code.append(code)
+        self._source.append(source)
+        self._balance.append(invoice['BalanceDueAmount'])
+        self._subtotal.append(invoice['Subtotal'])
+        self._tax.append(invoice['TotalTax'])
+        self._total.append(invoice['TotalAmount'])
+        return code
+
+    def finish(self):
+        """
+        Converts the typed columns into NumPy arrays. Call once every invoice
+        has been added.
+        """
+        self.date = np.frombuffer(self._date, dtype=np.int64) \
+            .astype('datetime64[D]')
+        self.due_date = np.frombuffer(self._due_date, dtype=np.int64) \
+            .astype('datetime64[D]')
+        self.code = np.frombuffer(self._code, dtype=np.int64)
+        self.source = np.frombuffer(self._source, dtype=np.int64)
+        self.balance = np.frombuffer(self._balance, dtype=np.float64)
+        self.subtotal = np.frombuffer(self._subtotal, dtype=np.float64)
+        self.tax = np.frombuffer(self._tax, dtype=np.float64)
+        self.total = np.frombuffer(self._total, dtype=np.float64)
+
+        if DEBUG:
+            print(MSG_PREFIX + f'{len(self)} invoices for '
+                               f'{len(self.customers)} customers.')
+        return self
+
+    def totals(self):
+        """
+        Returns the total balance due for each customer code.
+        """
+        return np.bincount(self.code, weights=self.balance,
+                           minlength=len(self.customers))
+
+    def counts(self):
+        """
+        Returns the number of invoices for each customer code.
+        """
+        return np.bincount(self.code, minlength=len(self.customers))
+
+    def oldest_due(self):
+        """
+        Returns the earliest due date for each customer code.
+        """
+        oldest = np.full(len(self.customers), np.iinfo(np.int64).max,
+                         dtype=np.int64)
+        np.minimum.at(oldest, self.code, self.due_date.astype(np.int64))
+        return oldest.astype('datetime64[D]')
+
+    def ages(self, today=None):
+        """
+        Returns the number of days each invoice is past its due date as at
+        today (default the current date).
+        """
+        if today is None:
+            today = datetime.date.today()
+        return (np.datetime64(today, 'D') - self.due_date).astype(np.int64)
+
+    def overdue_totals(self, days_over, today=None):
+        """
+        Returns the total balance for each customer code of the invoices due
+        days_over or more days ago.
+        """
+        overdue = self.ages(today) >= days_over
+        return np.bincount(self.code[overdue], weights=self.balance[overdue],
+                           minlength=len(self.customers))
+
+    def aged_totals(self, buckets, today=None):
+        """
+        Returns an array of balances with a row for each customer code and a
+        column for each aging bucket. Given buckets [30, 60, 90], the columns
+        hold invoices due 30-59, 60-89 and 90 or more days ago.
+        """
+        buckets = np.asarray(sorted(buckets))
+        band = np.searchsorted(buckets, self.ages(today), side='right') - 1
+        aged = band >= 0
+        totals = np.bincount(self.code[aged] * len(buckets) + band[aged],
+                             weights=self.balance[aged],
+                             minlength=len(self.customers) * len(buckets))
+        return totals.reshape(len(self.customers), len(buckets))
+
+    def source_totals(self, days_over, sources, today=None):
+        """
+        Returns the number of invoices, the number of customers and the total
+        balance of invoices due days_over or more days ago for each of the
+        given number of source codes.
+        """
+        counts = np.bincount(self.source, minlength=sources)
+        pairs = np.unique(self.source * len(self.customers) + self.code)
+        customers = np.bincount(pairs // max(len(self.customers), 1),
+                                minlength=sources)
+        overdue = self.ages(today) >= days_over
+        totals = np.bincount(self.source[overdue],
+                             weights=self.balance[overdue],
+                             minlength=sources)
+        return counts, customers, totals
+
+    def rows(self):
+        """
+        Yields each invoice as a detailed log row, in the order they were
+        added: Number, Date (d/m/y), DisplayID, Name, BalanceDueAmount,
+        Subtotal, TotalTax, TotalAmount and JournalMemo.
+        """
+        dates = np.datetime_as_string(self.date)
+        balance = self.balance.tolist()
+        subtotal = self.subtotal.tolist()
+        tax = self.tax.tolist()
+        total = self.total.tolist()
+        for i, code in enumerate(self.code.tolist()):
+            dt_ymd = dates[i]
+            yield [self.number[i],
+                   f"{dt_ymd[8:10]}/{dt_ymd[5:7]}/{dt_ymd[0:4]}",
+                   self.customers[code],
+                   self.names[code],
+                   balance[i],
+                   subtotal[i],
+                   tax[i],
+                   total[i],
+                   self.memo[i]]
+
+    def __len__(self):
+        return len(self.number)
+
+
+def bucket_labels(buckets):
+    """
+    Returns a label for each aging bucket, e.g. ['30-59', '60-89', '90+'].
+    """
+    buckets = sorted(buckets)
+    labels = [f'{start}-{end - 1}' for start, end in zip(buckets, buckets[1:])]
+    return labels + [f'{buckets[-1]}+'] if buckets else labels
+
+
+def day_number(timestamp):
+    """
+    Converts a MYOB date such as '2020-11-30T00:00:00' into days since
+    1970-01-01.
+    """
+    return datetime.date.fromisoformat(timestamp[0:10]).toordinal() - EPOCH
@@ -0,0 +1,278 @@
+import RunMetrics
+import Settings
+import csv
+import datetime
+import gzip
+import os
+import queue
+import threading
+
+DEBUG = False
+ERROR_PREFIX = '>> Error from LogPipeline >> '
+MSG_PREFIX = 'Message from LogPipeline >> '
+
+# Overdue logs written from a single pass over the invoices and customers:
+# > logs = LogPipeline.LogPipeline.from_config(stamp, invoice_header,
+#                                              customer_header, labels)
+# > logs.add_invoice(row) / logs.add_customer(row) / logs.finish()
+# > Runs over several company files: logs.add_company_files(header, rows)
+# > Wait for the files once Syrinx is updated: logs.close()
+
+config = Settings.config
+curpath = Settings.curpath
+
+
+class TsvSink:
+    """
+    Tab separated detailed and summary logs.
+    """
+
+    extension = '.txt'
+
+    def __init__(self, stamp, invoice_header, customer_header, labels):
+        self.folder = config.get("DEFAULT", "folder_location")
+        self.stamp = stamp
+        self.filenames = ["log_" + stamp + "_detailed" + self.extension,
+                          "log_" + stamp + "_summary" + self.extension]
+        self.paths = [self.folder + filename for filename in self.filenames]
+        self.headers = [invoice_header, customer_header]
+        self.files = list()
+        self.writers = list()
+
+    def open_file(self, path):
+        return open(path, 'w', newline='')
+
+    def writer(self, file):
+        return csv.writer(file, delimiter='\t', quotechar='|',
+                          quoting=csv.QUOTE_MINIMAL)
+
+    def open(self):
+        for path, header in zip(self.paths, self.headers):
+            file = self.open_file(path)
+            self.files.append(file)
+            self.writers.append(self.writer(file))
+            self.writers[-1].writerow(header)
+
+    def invoices(self, rows):
+        self.writers[0].writerows(rows)
+
+    def customers(self, rows):
+        self.writers[1].writerows(rows)
+
+    def company_files(self, rows):
+        """
+        Writes the per company file results, header first, to their own log.
+        """
+        filename = "log_" + self.stamp + "_files" + self.extension
+        with self.open_file(self.folder + filename) as file:
+            self.writer(file).writerows(rows)
+        self.filenames.append(filename)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        return self.filenames
+
+
+class CsvGzSink(TsvSink):
+    """
+    Gzipped CSV copies of the detailed and summary logs for archiving.
+    """
+
+    extension = '.csv.gz'
+
+    def open_file(self, path):
+        return gzip.open(path, 'wt', newline='')
+
+    def writer(self, file):
+        return csv.writer(file)
+
+
+class XlsxSink:
+    """
+    The Excel log, streamed into a copy of LogTemplate.xlsx and emailed on
+    the send_on_day unless the run is cancelled.
+    """
+
+    def __init__(self, stamp, invoice_header, customer_header, labels):
+        import OverdueLog
+        self.log = OverdueLog
+        self.path, self.filename = OverdueLog.excel_log_path(stamp)
+        self.labels = labels
+        self.wb = None
+        self.email = True
+
+    def open(self):
+        with RunMetrics.metrics.timer('excel_seconds', step='open'):
+            self.wb = self.log.LogWorkbook(
+                os.path.join(curpath, 'LogTemplate.xlsx'),
+                datetime.date.today().strftime("%d/%m/%Y"), self.labels)
+
+    def invoices(self, rows):
+        with RunMetrics.metrics.timer('excel_seconds', step='rows'):
+            for row in rows:
+                self.wb.add_detail(row)
+
+    def customers(self, rows):
+        with RunMetrics.metrics.timer('excel_seconds', step='rows'):
+            for row in rows:
+                self.wb.add_summary(row)
+
+    def close(self):
+        with RunMetrics.metrics.timer('excel_seconds', step='save'):
+            self.wb.save(self.path)
+        if self.email:
+            self.log.email_if_due(self.path, self.filename)
+        return [self.filename]
+
+    def cancel(self):
+        self.email = False
+
+
+# Sinks that can be named in the [LOGS] section of settings.ini
+SINKS = {'tsv': TsvSink,
+         'xlsx': XlsxSink,
+         'csv.gz': CsvGzSink}
+
+
+class LogPipeline:
+    """
+    Fans the invoice and customer rows of a run out to each sink. Rows are
+    buffered into batches and written by a background thread, so writing
+    the logs overlaps with fetching invoices and updating Syrinx. A sink
+    is any object with open, invoices(rows), customers(rows) and close
+    methods, close returning the names of the files written. Sinks with a
+    company_files(rows) method also get the per company file results, and
+    those with a cancel method are told when the run is aborted.
+    stamp is the run's stamp in the log file names, if known.
+    """
+
+    def __init__(self, sinks, batch_size=1000, max_batches=8, stamp=None):
+        self.sinks = sinks
+        self.stamp = stamp
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=max_batches)
+        self.invoice_rows = list()
+        self.customer_rows = list()
+        self.error = None
+        self.filenames = list()
+        self.finished = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, stamp, invoice_header, customer_header, labels=(),
+                    names=None):
+        """
+        Builds a pipeline with the sinks listed in the [LOGS] section of
+        settings.ini, or the named sinks if given.
+        """
+        if names is None:
+            names = sink_names()
+        sinks = [SINKS[name](stamp, invoice_header, customer_header,
+                             list(labels))
+                 for name in names]
+        return cls(sinks,
+                   config.getint('LOGS', 'batch_size', fallback=1000),
+                   config.getint('LOGS', 'max_batches', fallback=8),
+                   stamp)
+
+    def run(self):
+        try:
+            for sink in self.sinks:
+                sink.open()
+        except Exception as e:
+            self.error = e
+
+        # After an error, batches are still taken so the producer is never
+        # left blocked, but no longer written
+        for kind, rows in iter(self.batches.get, None):
+            if self.error is not None:
+                continue
+            try:
+                for sink in self.sinks:
+                    write = getattr(sink, kind, None)
+                    if write is not None:
+                        write(rows)
+            except Exception as e:
+                self.error = e
+
+        if self.error is None:
+            try:
+                for sink in self.sinks:
+                    self.filenames.extend(sink.close())
+            except Exception as e:
+                self.error = e
+
+    def add_invoice(self, row):
+        self.invoice_rows.append(row)
+        if len(self.invoice_rows) >= self.batch_size:
+            self.batches.put(('invoices', self.invoice_rows))
+            self.invoice_rows = list()
+
+    def add_customer(self, row):
+        self.customer_rows.append(row)
+        if len(self.customer_rows) >= self.batch_size:
+            self.batches.put(('customers', self.customer_rows))
+            self.customer_rows = list()
+
+    def add_company_files(self, header, rows):
+        """
+        Sends the results of each company file in a multi-file run, one row
+        per file under the given header.
+        """
+        self.batches.put(('company_files', [header] + list(rows)))
+
+    def finish(self):
+        """
+        Sends any buffered rows and marks the end of the run. The sinks carry
+        on writing in the background until close is called.
+        """
+        if self.finished:
+            return
+        if self.invoice_rows:
+            self.batches.put(('invoices', self.invoice_rows))
+        if self.customer_rows:
+            self.batches.put(('customers', self.customer_rows))
+        self.invoice_rows = list()
+        self.customer_rows = list()
+        self.batches.put(None)
+        self.finished = True
+
+    def close(self):
+        """
+        Waits for every sink to finish and returns the names of the files
+        written. An error raised by a sink is raised again here.
+        """
+        self.finish()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if DEBUG:
+            print(MSG_PREFIX + 'Logs written: ' + ', '.join(self.filenames))
+        return self.filenames
+
+    def abort(self):
+        """
+        Closes the pipeline after a failed run, printing rather than raising
+        any sink error.
+        """
+        for sink in self.sinks:
+            cancel = getattr(sink, 'cancel', None)
+            if cancel is not None:
+                cancel()
+        try:
+            return self.close()
+        except Exception as e:
+            print(ERROR_PREFIX + str(e))
+            return self.filenames
+
+
+def sink_names():
+    """
+    Returns the names of the sinks listed in the [LOGS] section of
+    settings.ini.
+    """
+    return [name.strip() for name in
+            config.get('LOGS', 'sinks', fallback='tsv, xlsx').split(',')
+            if name.strip()]
@@ -1,16 +1,23 @@
 __author__ = 'Jade McKenzie', 'Tyler McCamley'
 
-import requests
-import requests_oauthlib
-import configparser
+import RunMetrics
+import Settings
 import json
 import os
-import sys
+import random
+import tempfile
+import threading
+import time
 
 DEBUG = False
 ERROR_PREFIX = '>> Error from MyobAuth >> '
 MSG_PREFIX = 'Message from MyobAuth >> '
 
+# Invoice fields used by the overdue logs in SetOverdue
+OVERDUE_SELECT = ['Number', 'Date', 'Customer/DisplayID', 'Customer/Name',
+                  'BalanceDueAmount', 'Subtotal', 'TotalTax', 'TotalAmount',
+                  'JournalMemo', 'Terms/DueDate']
+
 
 # Program start is only used for debug purposes
 def program_start(run):
@@ -29,6 +36,8 @@ def program_start(run):
             app.check_token()
         elif entry == 'update token':
             app.update_token()
+        elif entry == 'check session':
+            app.print_connection_stats()
         elif entry == 'request':
             app.myob_request('companyfile')
         elif entry == 'request overdue':
@@ -40,6 +49,288 @@ def program_start(run):
             continue
 
 
+class MyobRequestError(Exception):
+    """
+    Raised when a MYOB request cannot be completed within its retries,
+    deadline or the daily call limit.
+    """
+
+
+class RequestScheduler:
+    """
+    Paces every MYOB request through a token bucket so calls stay within the
+    per-second limit, keeps count of calls against the daily limit and
+    retries throttled (429), unavailable (5xx) and dropped requests. Retries
+    wait for Retry-After when MYOB sends it, otherwise for an exponential
+    backoff with full jitter. A 429 pauses the whole bucket until its
+    Retry-After has passed, so every caller waits, not only the one that
+    was throttled. Each request, including its retries, must finish
+    within a deadline. Settings are read from the [HTTP] section of
+    settings.ini.
+    """
+
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, config):
+        self.rate = config.getfloat('HTTP', 'rate_per_second', fallback=8)
+        self.burst = config.getfloat('HTTP', 'burst', fallback=8)
+        self.daily_limit = config.getint('HTTP', 'daily_limit',
+                                         fallback=1000000)
+        self.max_retries = config.getint('HTTP', 'max_retries', fallback=5)
+        self.backoff_base = config.getfloat('HTTP', 'backoff_base',
+                                            fallback=0.5)
+        self.backoff_cap = config.getfloat('HTTP', 'backoff_cap', fallback=30)
+        self.deadline = config.getfloat('HTTP', 'request_deadline',
+                                        fallback=120)
+
+        self.lock = threading.Lock()
+        self.allowance = self.burst
+        self.last_refill = time.monotonic()
+        # No calls are allowed before this time after a 429
+        self.paused_until = 0
+        self.day = time.strftime('%Y-%m-%d')
+        self.calls_today = 0
+        self.retries = 0
+
+    def acquire(self, deadline_at):
+        """
+        Waits until the token bucket allows another call, counting it against
+        the daily limit.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    # The bucket refills from empty once the pause is over
+                    self.allowance = 0
+                    self.last_refill = now
+                    wait = self.paused_until - now
+                else:
+                    self.allowance = min(self.burst, self.allowance
+                                         + (now - self.last_refill)
+                                         * self.rate)
+                    self.last_refill = now
+                    wait = None
+
+                today = time.strftime('%Y-%m-%d')
+                if today != self.day:
+                    self.day = today
+                    self.calls_today = 0
+                if self.calls_today >= self.daily_limit:
+                    raise MyobRequestError('Daily MYOB call limit of '
+                                           f'{self.daily_limit} reached.')
+
+                if wait is None and self.allowance >= 1:
+                    self.allowance -= 1
+                    self.calls_today += 1
+                    return
+                if wait is None:
+                    wait = (1 - self.allowance) / self.rate
+
+            if now + wait > deadline_at:
+                raise MyobRequestError('Request deadline passed while waiting '
+                                       'for the rate limit.')
+            time.sleep(wait)
+
+    def send(self, send_request, timeout):
+        """
+        Calls send_request(timeout) until it returns a response that should
+        not be retried and returns that response. The read timeout of each
+        attempt is cut short so the request never runs past its deadline.
+        """
+        import requests
+
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+
+        metrics = RunMetrics.metrics
+        while True:
+            self.acquire(deadline_at)
+            remaining = deadline_at - time.monotonic()
+            metrics.count('myob_requests')
+            started = time.perf_counter()
+            try:
+                response = send_request((timeout[0],
+                                         max(min(timeout[1], remaining), 1)))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.count('myob_responses', status='error')
+                error = e
+                retry_after = None
+                throttled = False
+            else:
+                metrics.observe('myob_request_seconds',
+                                time.perf_counter() - started)
+                metrics.count('myob_responses',
+                              status=str(response.status_code))
+                metrics.count('myob_bytes_received', len(response.content))
+                if response.status_code not in self.retry_status:
+                    return response
+                error = MyobRequestError(f'HTTP {response.status_code} from '
+                                         f'{response.url}')
+                retry_after = retry_after_seconds(response)
+                throttled = response.status_code == 429
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise MyobRequestError(f'Gave up after {attempt} attempts: '
+                                       f'{error}') from error
+
+            if retry_after is None:
+                retry_after = random.uniform(
+                    0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            if time.monotonic() + retry_after > deadline_at:
+                raise MyobRequestError(f'Request deadline passed: {error}') \
+                    from error
+
+            with self.lock:
+                self.retries += 1
+                if throttled:
+                    self.paused_until = max(self.paused_until,
+                                            time.monotonic() + retry_after)
+                    self.allowance = 0
+            metrics.count('myob_retries')
+            if DEBUG:
+                print(MSG_PREFIX + f'{error}, retrying in {retry_after:.1f}s')
+            time.sleep(retry_after)
+
+
+def retry_after_seconds(response):
+    """
+    Returns the delay asked for by a Retry-After header, given either in
+    seconds or as an HTTP date, or None if there is no usable header.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def save_config(config, path):
+    """
+    Writes config to path atomically: the file is written and flushed to a
+    temporary file in the same folder, then moved over the original, so a
+    crash part way through never leaves a truncated settings.ini.
+    """
+    folder = os.path.dirname(path) or '.'
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.settings-',
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as file:
+            config.write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+class TokenManager:
+    """
+    Holds the MYOB access and refresh tokens. The access token is refreshed
+    ahead of its expiry (expires_in from the token response, less
+    token_refresh_margin seconds from the [MYOB] section of settings.ini).
+    Concurrent callers share a single in-flight refresh, and new tokens are
+    saved to settings.ini with an atomic replace. After a failed refresh,
+    the current token is used without another attempt for
+    token_retry_seconds, so each page does not repeat the failing request.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.Lock()
+        self.access_token = api.config.get('TOKENS', 'Access')
+        self.refresh_token = api.config.get('TOKENS', 'Refresh')
+        # Unknown expiry is treated as expired so the first call refreshes
+        self.expires_at = api.config.getfloat('TOKENS', 'Expires', fallback=0)
+        self.margin = api.config.getfloat('MYOB', 'token_refresh_margin',
+                                          fallback=120)
+        self.retry_seconds = api.config.getfloat('MYOB', 'token_retry_seconds',
+                                                 fallback=300)
+        # No refresh ahead of expiry is tried before this time
+        self.retry_at = 0
+
+    def current(self):
+        """
+        Returns an access token that is valid for at least the refresh margin,
+        refreshing it first if needed.
+        """
+        now = time.time()
+        if now < self.expires_at - self.margin or now < self.retry_at:
+            return self.access_token
+        try:
+            return self.refresh(self.access_token)
+        except Exception as e:
+            # Fall back to the current token; an 'Errors' response from MYOB
+            # then leads to re-authorisation.
+            print(ERROR_PREFIX + str(e))
+            return self.access_token
+
+    def refresh(self, stale_token=None):
+        """
+        Exchanges the refresh token for a new access token and returns it. If
+        stale_token is given and another caller has already replaced it while
+        this one waited, that caller's token is returned without a second
+        refresh, as it is while refreshes are held off after a failure.
+        """
+        with self.lock:
+            if stale_token is not None and (self.access_token != stale_token
+                                            or time.time() < self.retry_at):
+                return self.access_token
+
+            token_data = f'client_id={self.api.dev_key}' \
+                         f'&client_secret={self.api.dev_secret}' \
+                         f'&grant_type=refresh_token' \
+                         f'&refresh_token={self.refresh_token}'
+            headers = {'Content-Type': "application/x-www-form-urlencoded"}
+
+            try:
+                token = self.api.http_request("POST",
+                                              self.api.token_url,
+                                              data=token_data,
+                                              headers=headers)
+
+                if DEBUG:
+                    # Prints access token Post response (200 = Success)
+                    print(token.status_code)
+
+                token.raise_for_status()
+            except Exception:
+                self.retry_at = time.time() + self.retry_seconds
+                raise
+            self.store(token.json())
+            RunMetrics.metrics.count('myob_token_refreshes')
+            return self.access_token
+
+    def store(self, token_data):
+        """
+        Keeps the tokens and expiry from a token response and saves them.
+        Contains: access_token, token_type, scope, uid, username,
+        refresh_token, expires_in
+        """
+        if DEBUG:
+            print(token_data)
+
+        self.access_token = token_data['access_token']
+        self.refresh_token = token_data['refresh_token']
+        self.expires_at = time.time() + float(token_data.get('expires_in', 0))
+        self.retry_at = 0
+
+        # Write new tokens to config and save config
+        self.api.config.set('TOKENS', 'Access', self.access_token)
+        self.api.config.set('TOKENS', 'Refresh', self.refresh_token)
+        self.api.config.set('TOKENS', 'Expires', str(int(self.expires_at)))
+        save_config(self.api.config, self.api.cfgpath)
+
+
 class EagleMyobApi:
 
     dev_key = ''
@@ -53,20 +344,133 @@ class EagleMyobApi:
     auth_state = None
 
     token_url = 'https://secure.myob.com/oauth2/v1/authorize/'
-
-    config = configparser.ConfigParser()
-    curpath = os.path.dirname(os.path.realpath(sys.argv[0]))
-    cfgpath = os.path.join(curpath, 'settings.ini')
-    config.read(cfgpath)
-
-    access_token = config.get('TOKENS', 'Access')
-    refresh_token = config.get('TOKENS', 'Refresh')
-
-    oauth = requests_oauthlib.OAuth2Session(dev_key,
-                                            redirect_uri=dev_redirect_uri,
-                                            scope=scope)
-    auth_url, state = oauth.authorization_url(
-        'https://secure.myob.com/oauth2/account/authorize/?')
+    api_url = 'https://ar2.api.myob.com/accountright/'
+
+    config = Settings.config
+    curpath = Settings.curpath
+    cfgpath = Settings.cfgpath
+
+    # OAuth session, authorisation URL and state, created on first use
+    oauth = None
+    oauth_url = None
+    oauth_state = None
+
+    def __init__(self):
+        self.tokens = TokenManager(self)
+
+    @classmethod
+    def oauth_session(cls):
+        """
+        Returns the OAuth session used to authorise with MYOB, creating it
+        and the authorisation URL on first use.
+        """
+        if cls.oauth is None:
+            import requests_oauthlib
+
+            cls.oauth = requests_oauthlib.OAuth2Session(
+                cls.dev_key, redirect_uri=cls.dev_redirect_uri,
+                scope=cls.scope)
+            cls.oauth_url, cls.oauth_state = cls.oauth.authorization_url(
+                'https://secure.myob.com/oauth2/account/authorize/?')
+        return cls.oauth
+
+    @property
+    def auth_url(self):
+        self.oauth_session()
+        return self.oauth_url
+
+    @property
+    def state(self):
+        self.oauth_session()
+        return self.oauth_state
+
+    # Shared keep-alive session and scheduler for all MYOB and token traffic
+    session = None
+    session_adapter = None
+    scheduler = None
+
+    @classmethod
+    def http_session(cls):
+        """
+        Returns the pooled session shared by every MYOB and token request,
+        creating it on first use. Pool sizes are read from the [HTTP] section
+        of settings.ini. Requests decodes gzip/deflate responses automatically.
+        """
+        if cls.session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            cls.session_adapter = HTTPAdapter(
+                pool_connections=cls.config.getint('HTTP', 'pool_connections',
+                                                   fallback=4),
+                pool_maxsize=cls.config.getint('HTTP', 'pool_maxsize',
+                                               fallback=8),
+                pool_block=True)
+            cls.session = requests.Session()
+            cls.session.mount('https://', cls.session_adapter)
+            cls.session.mount('http://', cls.session_adapter)
+            cls.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                        'Connection': 'keep-alive'})
+        return cls.session
+
+    @classmethod
+    def request_scheduler(cls):
+        """
+        Returns the rate limiting scheduler shared by every MYOB and token
+        request, creating it on first use.
+        """
+        if cls.scheduler is None:
+            cls.scheduler = RequestScheduler(cls.config)
+        return cls.scheduler
+
+    def http_request(self, method, url, **kwargs):
+        """
+        Sends a request through the shared session and scheduler. Connect and
+        read timeouts default to the values in the [HTTP] section of
+        settings.ini. Raises MyobRequestError if the request still fails
+        after its retries.
+        """
+        timeout = kwargs.pop('timeout',
+                             (self.config.getfloat('HTTP', 'connect_timeout',
+                                                   fallback=10),
+                              self.config.getfloat('HTTP', 'read_timeout',
+                                                   fallback=60)))
+        session = self.http_session()
+        return self.request_scheduler().send(
+            lambda attempt_timeout: session.request(method, url,
+                                                    timeout=attempt_timeout,
+                                                    **kwargs),
+            timeout)
+
+    def connection_stats(self):
+        """
+        Returns the number of requests sent through the shared session, the
+        number of connections opened to serve them and how many requests
+        reused an already open connection.
+        """
+        requests_sent = 0
+        connections = 0
+        if self.session_adapter is not None:
+            pools = self.session_adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {'requests': requests_sent,
+                'connections': connections,
+                'reused': max(requests_sent - connections, 0)}
+
+    def print_connection_stats(self):
+        try:
+            stats = self.connection_stats()
+            print(MSG_PREFIX + f"{stats['requests']} requests over "
+                               f"{stats['connections']} connections "
+                               f"({stats['reused']} reused)")
+        except Exception as e:
+            print(ERROR_PREFIX + str(e))
 
     def get_user_authorisation(self):
 
@@ -132,24 +536,16 @@ class EagleMyobApi:
                          f'&grant_type=authorization_code'
             headers = {'Content-Type': "application/x-www-form-urlencoded"}
 
-            token = requests.request("POST",
-                                     self.token_url,
-                                     data=token_data,
-                                     headers=headers)
+            token = self.http_request("POST",
+                                      self.token_url,
+                                      data=token_data,
+                                      headers=headers)
 
             # Print access token Post response
             print(MSG_PREFIX + str(token.status_code))
 
-            # Store returned JSON response.
-            # Contains: access_token, token_type, scope, uid, username,
-            # refresh_token, expires_in
-            token_data = token.json()
-
-            # Write new tokens to config and save config
-            self.config.set('TOKENS', 'Access', token_data['access_token'])
-            self.config.set('TOKENS', 'Refresh', token_data['refresh_token'])
-            with open('settings.ini', 'w') as file:
-                self.config.write(file)
+            # Store returned JSON response and save config
+            self.tokens.store(token.json())
 
             print(MSG_PREFIX + "Token Retrieved")
 
@@ -158,204 +554,402 @@ class EagleMyobApi:
 
     def check_token(self):
         try:
-            # Retrieve up to date access/refresh variables from config
-            self.access_token = self.config.get('TOKENS', 'Access')
-            self.refresh_token = self.config.get('TOKENS', 'Refresh')
-
-            if self.access_token is None:
+            # Up to date access/refresh tokens held by the token manager
+            if not self.tokens.access_token:
                 print(MSG_PREFIX + 'No Access token')
             else:
-                print(MSG_PREFIX + f'Access Token: {self.access_token}')
-            if self.refresh_token is None:
+                print(MSG_PREFIX + f'Access Token: {self.tokens.access_token}')
+                print(MSG_PREFIX + 'Access Token Expires: '
+                      + time.ctime(self.tokens.expires_at))
+            if not self.tokens.refresh_token:
                 print(MSG_PREFIX + 'No Refresh Token')
             else:
-                print(MSG_PREFIX + f'Refresh Token: {self.refresh_token}')
+                print(MSG_PREFIX
+                      + f'Refresh Token: {self.tokens.refresh_token}')
         except Exception as e:
             print(ERROR_PREFIX + str(e))
 
     def update_token(self):
         try:
-            token_data = f'client_id={self.dev_key}' \
-                         f'&client_secret={self.dev_secret}' \
-                         f'&grant_type=refresh_token' \
-                         f'&refresh_token={self.refresh_token}'
-            headers = {'Content-Type': "application/x-www-form-urlencoded"}
-
-            token = requests.request("POST",
-                                     self.token_url,
-                                     data=token_data,
-                                     headers=headers)
-
-            if DEBUG:
-                # Prints access token Post response (200 = Success)
-                print(token.status_code)
-
-            # Store returned json response
-            token_data = token.json()
-
-            if DEBUG:
-                print(token_data)
-
-            # Write new tokens to config and save config
-            self.config.set('TOKENS', 'Access', token_data['access_token'])
-            self.config.set('TOKENS', 'Refresh', token_data['refresh_token'])
-            with open('settings.ini', 'w') as file:
-                self.config.write(file)
-
-            # Updates access/refresh variables from config for requests
-            self.access_token = self.config.get('TOKENS', 'Access')
-            self.refresh_token = self.config.get('TOKENS', 'Refresh')
-
+            self.tokens.refresh()
             print(MSG_PREFIX + "Tokens Successfully Updated")
         except Exception as e:
             print(ERROR_PREFIX + str(e))
 
-    def myob_request(self, provided_request, pr_balance=0.0, pr_days_over=60):
-        if provided_request == 'companyfile':
-            request_choice = {'request_type': "GET",
-                              'request_url':
-                                  'https://api.myob.com/accountright',
-                              'request_payload': {},
-                              'request_parameters': {},
-                              'request_headers':
-                                  {'Authorization': 'Bearer '
-                                                    + self.access_token,
-                                   'x-myobapi-key': self.dev_key,
-                                   'x-myobapi-version': 'v2',
-                                   'Accept-Encoding': 'gzip,deflate'}}
-        elif provided_request == 'overdue':
-
-            def overdue_filter(balance=0.0, days_over=60):
-                from datetime import datetime, timedelta, date
-                """
-                Retrieves and stores a MYOB JSON file with filters applied. 
-                'Balance' is to be greater than the given value (default $0.00)
-                and 'Date' must be prior to current date less days_over (default
-                60 days).
-                """
-                d = datetime.today() - timedelta(days=days_over)
-
-                uri = "https://ar2.api.myob.com/accountright/"
-                file_id = ""
-                invoices = "/Sale/Invoice"
-
-                final_url = uri + file_id + invoices
-                filters = f"?$filter=BalanceDueAmount gt {str(balance)}M and" \
-                          f" Terms/DueDate le datetime'" \
-                          f"{str(date(d.year, d.month, d.day).isoformat())}'"
-                if DEBUG:
-                    print(filters)
-                    print(" Final URL: " + final_url + filters)
-                return final_url + filters
-
-            request_choice = {'request_type': "GET",
-                              'request_url': overdue_filter(pr_balance,
-                                                            pr_days_over),
-                              'request_payload': {},
-                              'request_parameters': {},
-                              'request_headers':
-                                  {'Authorization': 'Bearer '
-                                                    + self.access_token,
-                                   'x-myobapi-key': self.dev_key,
-                                   'x-myobapi-version': 'v2',
-                                   'Accept-Encoding': 'gzip,deflate'}}
+    def build_query(self, endpoint, file_id=None, filters=None, select=None,
+                    orderby=None, top=None):
+        """
+        Builds an AccountRight OData URL for the given endpoint (e.g.
+        'Sale/Invoice') in the company file file_id, which defaults to file_id
+        in the [MYOB] section of settings.ini. filters is a list of conditions
+        joined with 'and'; select and orderby are lists of field paths. top
+        sets the page size (MYOB allows up to 1000 items per page).
+        """
+        if file_id is None:
+            file_id = self.config.get('MYOB', 'file_id', fallback='')
+
+        options = []
+        if filters:
+            options.append('$filter=' + ' and '.join(filters))
+        if select:
+            options.append('$select=' + ','.join(select))
+        if orderby:
+            options.append('$orderby=' + ','.join(orderby))
+        if top is not None:
+            options.append(f'$top={int(top)}')
+
+        final_url = self.api_url + file_id + '/' + endpoint.strip('/')
+        if options:
+            final_url += '?' + '&'.join(options)
+
+        if DEBUG:
+            print(" Final URL: " + final_url)
+        return final_url
+
+    def company_files(self):
+        """
+        Returns the IDs of the company files to fetch from, listed in
+        company_files in the [MYOB] section of settings.ini, or file_id if
+        no list is given.
+        """
+        files = [file_id.strip() for file_id in
+                 self.config.get('MYOB', 'company_files',
+                                 fallback='').split(',')
+                 if file_id.strip()]
+        return files or [self.config.get('MYOB', 'file_id', fallback='')]
+
+    def overdue_query(self, balance=0.0, days_over=60, file_id=None,
+                      display_ids=None):
+        """
+        Builds the query for invoices with a balance greater than the given
+        value (default $0.00) that fell due before the current date less
+        days_over (default 60 days). Only the fields used by the overdue logs
+        are requested. Given a list of display_ids, only the invoices of
+        those customers are requested.
+        """
+        from datetime import datetime, timedelta, date
+
+        d = datetime.today() - timedelta(days=days_over)
+        filters = [f"BalanceDueAmount gt {str(balance)}M",
+                   f"Terms/DueDate le datetime'"
+                   f"{str(date(d.year, d.month, d.day).isoformat())}'"]
+        if display_ids:
+            # Quotes in an OData string are escaped by doubling them
+            filters.append('(' + ' or '.join(
+                "Customer/DisplayID eq '" + display_id.replace("'", "''")
+                + "'" for display_id in display_ids) + ')')
+        return self.build_query(
+            'Sale/Invoice', file_id,
+            filters=filters,
+            select=OVERDUE_SELECT,
+            orderby=['Number'])
+
+    def request_headers(self):
+        return {'Authorization': 'Bearer ' + self.tokens.current(),
+                'x-myobapi-key': self.dev_key,
+                'x-myobapi-version': 'v2',
+                'Accept-Encoding': 'gzip,deflate'}
+
+    def build_request(self, provided_request, pr_balance=0.0, pr_days_over=60,
+                      file_id=None):
+        """
+        Returns the request type, URL, payload, parameters and headers for the
+        named request. A full URL, such as one from build_query, may be given
+        in place of a request name. Overdue requests are for the company file
+        file_id, by default file_id in settings.ini.
+        """
+        if provided_request == 'overdue':
+            request_url = self.overdue_query(pr_balance, pr_days_over, file_id)
+        elif '://' in provided_request:
+            request_url = provided_request
         else:
-            request_choice = {'request_type': "GET",
-                              'request_url':
-                                  'https://api.myob.com/accountright',
-                              'request_payload': {},
-                              'request_parameters': {},
-                              'request_headers':
-                                  {'Authorization': 'Bearer '
-                                                    + self.access_token,
-                                   'x-myobapi-key': self.dev_key,
-                                   'x-myobapi-version': 'v2',
-                                   'Accept-Encoding': 'gzip,deflate'}}
-
-        try:
-            if DEBUG:
-                print(MSG_PREFIX + 'Retrieving Request...')
-            response = \
-                requests.request(request_choice['request_type'],
-                                 request_choice['request_url'],
-                                 headers=request_choice['request_headers'],
-                                 params=request_choice['request_parameters'],
-                                 data=request_choice['request_payload'])
-
-            if DEBUG:
-                print(MSG_PREFIX + 'Request data retrieved.')
-            response = response.json()
-            try:
-                response_list = [response['Items']]
-            except Exception as e:
-                if DEBUG:
-                    print(e)
-                response_list = []
-                pass
-
-            # Checks if token is valid and current, or updates token.
-            if 'Errors' in response:
-                print(MSG_PREFIX + response['Errors'][0]['Name'])
-                print(MSG_PREFIX + 'Attempting to refresh token and retry.')
-
-                if self.retry_counter < 5:
-                    try:
-                        self.retry_counter += 1
-                        self.update_token()
-                        return self.myob_request(provided_request, pr_balance,
-                                                 pr_days_over)
-                    except Exception as e:
-                        print(ERROR_PREFIX + str(e))
-                        print(MSG_PREFIX + 'Re-authorisation may be required or '
-                                           'there may be a network issue.')
-                        self.get_user_authorisation()
-                        self.get_token()
-                        return self.myob_request(provided_request, pr_balance,
-                                                 pr_days_over)
-                elif self.retry_counter >= 5:
+            request_url = 'https://api.myob.com/accountright'
+
+        request_choice = {'request_type': "GET",
+                          'request_url': request_url,
+                          'request_payload': {},
+                          'request_parameters': {},
+                          'request_headers': self.request_headers()}
+        return request_choice
+
+    def iter_pages_parallel(self, request_choice, page_size, count, start):
+        """
+        Fetches the pages from item offset start up to count concurrently
+        using $top and $skip. The number of worker threads is set by
+        max_workers in the [HTTP] section of settings.ini. Pages are yielded
+        in the same order as the NextPageLink chain, each as soon as it and
+        every page before it have arrived.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from urllib.parse import urlsplit, urlunsplit
+
+        if not page_size:
+            return
+        skips = range(start, int(count), page_size)
+
+        # Paging options are sent as parameters, so drop any from the query
+        url = urlsplit(request_choice['request_url'])
+        query = '&'.join(option for option in url.query.split('&')
+                         if option and not option.startswith(('$top=',
+                                                               '$skip=')))
+        page_url = urlunsplit(url._replace(query=query))
+
+        def fetch_page(skip):
+            params = dict(request_choice['request_parameters'])
+            params.update({'$top': page_size, '$skip': skip})
+            page = self.http_request(request_choice['request_type'],
+                                     page_url,
+                                     headers=self.request_headers(),
+                                     params=params,
+                                     data=request_choice['request_payload'])
+            page.raise_for_status()
+            return page.json()
+
+        workers = self.config.getint('HTTP', 'max_workers', fallback=4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(fetch_page, skips)
+
+    def iter_next_links(self, request_choice, next_link):
+        """
+        Follows the NextPageLink chain from next_link, yielding each page.
+        A page that cannot be fetched raises rather than ending the
+        collection early.
+        """
+        while next_link is not None:
+            next_link_response = \
+                self.http_request(request_choice['request_type'],
+                                  url=next_link,
+                                  headers=self.request_headers(),
+                                  params=request_choice['request_parameters'],
+                                  data=request_choice['request_payload'])
+
+            next_link_response.raise_for_status()
+            next_link_response = next_link_response.json()
+            yield next_link_response
+            next_link = next_link_response.get('NextPageLink')
+
+    def iter_raw_pages(self, request_choice, parallel=False, resume=None):
+        """
+        Sends the request to MYOB and yields each page of the response as
+        the JSON object MYOB returned. Unpaged responses are yielded as a
+        single page holding the list under Items. With parallel set, pages
+        after the first are fetched concurrently instead of by following
+        NextPageLink. Given a resume point from a PageJournal, the pages
+        after it are fetched instead of starting from the first.
+        """
+        if resume is not None:
+            offset, page_size, count, last_page = resume
+            if parallel and count is not None:
+                yield from self.iter_pages_parallel(request_choice, page_size,
+                                                    count, offset)
+            elif last_page.get('NextPageLink'):
+                yield from self.iter_next_links(request_choice,
+                                                last_page['NextPageLink'])
+            elif count is not None and offset < count:
+                yield from self.iter_pages_parallel(request_choice, page_size,
+                                                    count, offset)
+            return
+
+        if DEBUG:
+            print(MSG_PREFIX + 'Retrieving Request...')
+        response = \
+            self.http_request(request_choice['request_type'],
+                              request_choice['request_url'],
+                              headers=request_choice['request_headers'],
+                              params=request_choice['request_parameters'],
+                              data=request_choice['request_payload'])
+
+        if DEBUG:
+            print(MSG_PREFIX + 'Request data retrieved.')
+        response = response.json()
+
+        # Unpaged responses such as the company file list are a plain list.
+        if isinstance(response, list):
+            yield {'Items': response}
+            return
+
+        # Checks if token is valid and current, or updates token.
+        if 'Errors' in response:
+            print(MSG_PREFIX + response['Errors'][0]['Name'])
+            print(MSG_PREFIX + 'Attempting to refresh token and retry.')
+
+            if self.retry_counter < 5:
+                try:
+                    self.retry_counter += 1
+                    self.update_token()
+                except Exception as e:
+                    print(ERROR_PREFIX + str(e))
                     print(MSG_PREFIX + 'Re-authorisation may be required or '
                                        'there may be a network issue.')
                     self.get_user_authorisation()
-                    self.check_token()
-                    self.retry_counter = 0
-                    return self.myob_request(provided_request, pr_balance,
-                                             pr_days_over)
-            elif 'NextPageLink' in response:
+                    self.get_token()
+            else:
+                print(MSG_PREFIX + 'Re-authorisation may be required or '
+                                   'there may be a network issue.')
+                self.get_user_authorisation()
+                self.check_token()
+                self.retry_counter = 0
+            request_choice['request_headers'] = self.request_headers()
+            yield from self.iter_raw_pages(request_choice, parallel)
+            return
+
+        if 'Items' not in response:
+            raise MyobRequestError('MYOB response has no Items: '
+                                   + json.dumps(response)[0:200])
+        yield response
+
+        if parallel and response.get('NextPageLink') \
+                and response.get('Count'):
+            yield from self.iter_pages_parallel(request_choice,
+                                                len(response['Items']),
+                                                response['Count'],
+                                                len(response['Items']))
+        elif response.get('NextPageLink'):
+            yield from self.iter_next_links(request_choice,
+                                            response['NextPageLink'])
+
+    def iter_pages(self, provided_request, pr_balance=0.0, pr_days_over=60,
+                   parallel=False, journal=False, file_id=None):
+        """
+        Sends the named request to MYOB and yields the items of each page of
+        the response as it arrives. With parallel set, pages after the first
+        are fetched concurrently instead of by following NextPageLink.
+
+        With journal set, each raw page is also written to a PageJournal for
+        the query. If the last pull of the same query was interrupted within
+        resume_minutes ([JOURNAL]), its journalled pages are yielded first and
+        the pull resumes after them.
+        """
+        request_choice = self.build_request(provided_request, pr_balance,
+                                            pr_days_over, file_id)
+
+        page_journal = None
+        resume = None
+        if journal:
+            import PageJournal
+            page_journal = PageJournal.PageJournal.for_query(
+                request_choice['request_url'],
+                file_id if file_id is not None
+                else self.config.get('MYOB', 'file_id', fallback=''))
+            resume = page_journal.resume_point()
+            if resume is None:
+                page_journal.start()
+            else:
+                print(MSG_PREFIX + f'Resuming from item {resume[0]} of '
+                                   f'{page_journal.path}')
+                yield from page_journal.pages()
+
+        for page in self.iter_raw_pages(request_choice, parallel, resume):
+            RunMetrics.metrics.count('myob_pages')
+            RunMetrics.metrics.count('myob_items', len(page['Items']))
+            if page_journal is not None:
+                page_journal.record(page)
+            yield page['Items']
+
+        if page_journal is not None:
+            page_journal.finish()
+
+        print('MYOB Authorisation request completed.')
+        self.print_connection_stats()
+
+    def iter_items(self, provided_request, pr_balance=0.0, pr_days_over=60,
+                   parallel=False, journal=False, file_id=None):
+        """
+        Yields the items of the named request one at a time, page by page, so
+        callers can process a collection without holding all of it in memory.
+        """
+        for page in self.iter_pages(provided_request, pr_balance, pr_days_over,
+                                    parallel, journal, file_id):
+            yield from page
+
+    def iter_company_files(self, provided_request, pr_balance=0.0,
+                           pr_days_over=60, parallel=False, journal=False,
+                           files=None, timings=None):
+        """
+        Sends the named request to each company file in files (default
+        company_files) at the same time and yields (file_id, item) pairs as
+        pages arrive from any of them. A single file is fetched without extra
+        threads. If a timings dictionary is given, the seconds taken by each
+        file are stored in it under the file ID. An error fetching any file
+        is raised once the others have stopped.
+        """
+        import queue
+        from concurrent.futures import ThreadPoolExecutor
+
+        if files is None:
+            files = self.company_files()
+
+        def fetch(file_id):
+            started = time.perf_counter()
+            try:
+                yield from self.iter_pages(provided_request, pr_balance,
+                                           pr_days_over, parallel, journal,
+                                           file_id)
+            finally:
+                if timings is not None:
+                    timings[file_id] = time.perf_counter() - started
+
+        if len(files) == 1:
+            for page in fetch(files[0]):
+                for item in page:
+                    yield files[0], item
+            return
+
+        # Pages are handed over through a bounded queue, so a slow consumer
+        # holds back the fetches rather than letting pages pile up
+        pages = queue.Queue(maxsize=2 * len(files))
+        stopping = threading.Event()
+
+        def put(file_id, page):
+            while not stopping.is_set():
                 try:
-                    next_link = response['NextPageLink']
-                    next_link_in_response = True
-
-                    while next_link_in_response is True:
-                        next_link_response = \
-                            requests.request(request_choice['request_type'],
-                                             url=next_link,
-                                             headers=request_choice[
-                                                 'request_headers'],
-                                             params=request_choice[
-                                                 'request_parameters'],
-                                             data=request_choice[
-                                                 'request_payload'])
-
-                        next_link_response = next_link_response.json()
-                        response_list.append(next_link_response['Items'])
-
-                        if next_link_response['NextPageLink'] is not None:
-                            next_link = next_link_response['NextPageLink']
-                        else:
-                            break
-
-                except Exception as e:
-                    print(ERROR_PREFIX + str(e))
-
-            print('MYOB Authorisation request completed.')
-
-            if DEBUG:
-                print(len(response_list))
+                    pages.put((file_id, page), timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            raise MyobRequestError('Company file fetch cancelled.')
 
-            return_list = []
-            for r_list in response_list:
-                for item in r_list:
-                    return_list.append(item)
+        def fetch_file(file_id):
+            try:
+                for page in fetch(file_id):
+                    put(file_id, page)
+            finally:
+                pages.put(None)
+
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            futures = [executor.submit(fetch_file, file_id)
+                       for file_id in files]
+            try:
+                remaining = len(files)
+                while remaining:
+                    entry = pages.get()
+                    if entry is None:
+                        remaining -= 1
+                        continue
+                    for item in entry[1]:
+                        yield entry[0], item
+            finally:
+                stopping.set()
+                # Let any fetch blocked on a full queue finish
+                while any(not future.done() for future in futures):
+                    try:
+                        pages.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            for future in futures:
+                future.result()
+
+    def myob_request(self, provided_request, pr_balance=0.0, pr_days_over=60,
+                     parallel=False, journal=False):
+        """
+        Sends the named request to MYOB and returns every item from every page
+        of the response as a single list. With journal set, the pages are
+        journalled so an interrupted request resumes where it stopped.
+        """
+        try:
+            return_list = list(self.iter_items(provided_request, pr_balance,
+                                               pr_days_over, parallel,
+                                               journal))
 
             if DEBUG:
                 print(len(return_list))
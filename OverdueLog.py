@@ -1,94 +1,356 @@
-import configparser
+import RunMetrics
+import Settings
 import os
-import sys
+import time
 
-# OPEN CONFIGURATION FILE
-config = configparser.ConfigParser()
-curpath = os.path.dirname(os.path.realpath(sys.argv[0]))
-cfgpath = os.path.join(curpath, 'settings.ini')
-config.read(cfgpath)
+# CONFIGURATION FILE, read once by Settings
+config = Settings.config
+curpath = Settings.curpath
 
+# Templates loaded by LogWorkbook, kept so a resident service reads each once
+templates = dict()
 
-def convert_log_to_excel(log_file_sum, log_file_det, date):
+# Date the log was last emailed, so a service running several times on the
+# send_on_day sends it once
+emailed_on = None
+
+
+def convert_log_to_excel(log_file_sum, log_file_det, date, streaming=None,
+                         email=True):
+    """
+    Writes the customer summary dictionary and the detailed rows of an
+    InvoiceTable into a copy of LogTemplate.xlsx. With streaming set (default
+    streaming in the [EXCEL] section of settings.ini), rows are written
+    through a LogWorkbook instead of editing the whole template in memory.
+    With email unset, the log is never emailed, even on the send_on_day.
+    """
     import openpyxl
     import datetime
     from openpyxl.styles import Font
 
-    # INTEGER REPRESENTATION OF DAY
-    day_number = {"Monday": 0,
-                  "Tuesday": 1,
-                  "Wednesday": 2,
-                  "Thursday": 3,
-                  "Friday": 4,
-                  "Saturday": 5,
-                  "Sunday": 6}
-
-    directory = config.get("DEFAULT", "folder_location")
-    email_day = day_number[config.get("EMAIL", "send_on_day")]
+    started = time.perf_counter()
+    if streaming is None:
+        streaming = config.getboolean("EXCEL", "streaming", fallback=False)
 
     # OPEN TEMPLATE
     templatepath = os.path.join(curpath, 'LogTemplate.xlsx')
     template_ex = templatepath
 
+    today = datetime.date.today().strftime("%d/%m/%Y")
+
+    # Aged balances follow the template's columns
+    aging_labels = list(
+        next(iter(log_file_sum.values()), [None] * 4)[3] or [])
+
+    directory_filename, filename = excel_log_path(date)
+
+    if streaming:
+        wb = LogWorkbook(template_ex, today, aging_labels)
+        for key, value in log_file_sum.items():
+            wb.add_summary([key] + value[0:3] + list(value[3].values()))
+        for row_entries in log_file_det.rows():
+            wb.add_detail(row_entries)
+        wb.save(directory_filename)
+        RunMetrics.metrics.observe('excel_seconds',
+                                   time.perf_counter() - started,
+                                   step='convert')
+        if email:
+            email_if_due(directory_filename, filename)
+        return
+
     # WRITE TO TEMPLATE
     wb = openpyxl.load_workbook(template_ex)
     ws = wb.active
 
-    today = datetime.date.today().strftime("%d/%m/%Y")
-
     # Sets date at top
     ws.cell(column=4, row=1, value=today)
 
     # LOG FILE SUMMARY
+    if aging_labels:
+        show_aging_columns(ws, aging_labels)
+
     # Inserts data via iteration and changes font
-    for row, row_entries in enumerate(log_file_sum.items(), start=7):
-        for column, value in enumerate(row_entries, start=1):
-            if type(value) is list:
-                for columns, items in enumerate(value, start=2):
-                    ws.cell(column=columns, row=row, value=items)
-                    ws.cell(column=columns, row=row).font = Font(
-                        name='Arial Narrow', size=11)
-            else:
-                ws.cell(column=column, row=row, value=value)
-                ws.cell(column=column, row=row).font = Font(
-                    name='Arial Narrow', size=11)
+    for row, (key, value) in enumerate(log_file_sum.items(), start=7):
+        row_entries = [key] + value[0:3] + list(value[3].values())
+        for column, entry in enumerate(row_entries, start=1):
+            ws.cell(column=column, row=row, value=entry)
+            ws.cell(column=column, row=row).font = Font(
+                name='Arial Narrow', size=11)
+            if column > 4:
+                ws.cell(column=column, row=row).number_format = \
+                    ws.cell(column=3, row=6).number_format
 
     # LOG FILE DETAILS
     ws = wb["Detailed"]
     ws.cell(column=6, row=1, value=today)
 
     # Inserts data via iteration and changes font
-    for row, row_entries in enumerate(log_file_det.items(), start=7):
+    for row, row_entries in enumerate(log_file_det.rows(), start=7):
         for column, value in enumerate(row_entries, start=1):
-            if type(value) is list:
-                for columns, items in enumerate(value, start=2):
-                    ws.cell(column=columns, row=row, value=items)
-                    ws.cell(column=columns, row=row).font = Font(
-                        name='Arial Narrow', size=11)
-
-            else:
-                ws.cell(column=column, row=row, value=value)
-                ws.cell(column=column, row=row).font = Font(
-                    name='Arial Narrow', size=11)
+            ws.cell(column=column, row=row, value=value)
+            ws.cell(column=column, row=row).font = Font(
+                name='Arial Narrow', size=11)
 
     # SAVE THE FILE
-    filename = r'Overdue_Log_' + date + '.xlsx'
-    directory_filename = directory + '\\' + filename
     wb.save(directory_filename)
+    RunMetrics.metrics.observe('excel_seconds', time.perf_counter() - started,
+                               step='convert')
+    if email:
+        email_if_due(directory_filename, filename)
 
-    if datetime.datetime.now().weekday() == email_day:
-        email_log(attachment_file=directory_filename, filename=filename)
+
+def excel_log_path(date):
+    """
+    Returns the path and file name of the Excel log for the given run.
+    """
+    directory = config.get("DEFAULT", "folder_location")
+    filename = r'Overdue_Log_' + date + '.xlsx'
+    return directory + '\\' + filename, filename
+
+
+def email_if_due(attachment_file, filename):
+    """
+    Emails the log if today is the send_on_day set in the [EMAIL] section of
+    settings.ini and it has not already been emailed today.
+    """
+    import datetime
+    global emailed_on
+
+    # INTEGER REPRESENTATION OF DAY
+    day_number = {"Monday": 0,
+                  "Tuesday": 1,
+                  "Wednesday": 2,
+                  "Thursday": 3,
+                  "Friday": 4,
+                  "Saturday": 5,
+                  "Sunday": 6}
+
+    email_day = day_number[config.get("EMAIL", "send_on_day")]
+    today = datetime.date.today()
+    if today.weekday() == email_day and emailed_on != today:
+        email_log(attachment_file=attachment_file, filename=filename)
+        emailed_on = today
+
+
+def show_aging_columns(ws, labels):
+    """
+    Adds a header for each aging bucket after the last summary column, styled
+    like the TotalOwing header, and unhides those columns in the template.
+    """
+    from copy import copy
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.dimensions import ColumnDimension
+
+    hidden = ws.column_dimensions['E']
+    last_column = hidden.max
+    for offset, label in enumerate(labels):
+        column = 5 + offset
+        letter = get_column_letter(column)
+        ws.column_dimensions[letter] = ColumnDimension(
+            ws, index=letter, width=ws.column_dimensions['C'].width)
+        header = ws.cell(column=column, row=6, value=label)
+        header._style = copy(ws.cell(column=3, row=6)._style)
+
+    # Keep the remaining template columns hidden
+    first_hidden = 5 + len(labels)
+    letter = get_column_letter(first_hidden)
+    ws.column_dimensions[letter] = ColumnDimension(
+        ws, index=letter, min=first_hidden, max=last_column,
+        width=hidden.width, hidden=True)
+
+
+class LogWorkbook:
+    """
+    Write-only copy of LogTemplate.xlsx. The header rows of each sheet are
+    copied from the template along with its column widths, row heights,
+    merged cells, filters, conditional formats and page setup. Rows added
+    after that are streamed to disk, every cell sharing one named style in
+    place of a Font object per cell. The loaded template is kept for later
+    logs until the file changes.
+    """
+
+    header_rows = 6
+
+    def __init__(self, template, today, aging_labels=None):
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.formula.translate import Translator
+        from openpyxl.styles import Font, NamedStyle
+
+        key = (template, os.path.getmtime(template), tuple(aging_labels or ()))
+        source = templates.get(key)
+        if source is None:
+            source = openpyxl.load_workbook(template)
+            if aging_labels:
+                show_aging_columns(source["Summary"], aging_labels)
+            templates.clear()
+            templates[key] = source
+        source["Summary"].cell(column=4, row=1, value=today)
+        source["Detailed"].cell(column=6, row=1, value=today)
+
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.wb.add_named_style(NamedStyle(name="Log Entry",
+                                           font=Font(name='Arial Narrow',
+                                                     size=11)))
+        self.summary = self.copy_sheet(source["Summary"])
+        self.detailed = self.copy_sheet(source["Detailed"])
+
+        # Every data cell copies the style of one of these
+        self.entry = WriteOnlyCell(self.summary)
+        self.entry.style = "Log Entry"
+        self.amount = WriteOnlyCell(self.summary)
+        self.amount.style = "Log Entry"
+        self.amount.number_format = \
+            source["Summary"].cell(column=3, row=6).number_format
+
+        # Formulas filled down the template's Detailed rows, such as the
+        # exclusion lookup in column J, and how far down they go
+        self.detail_formulas = list()
+        for source_cell in source["Detailed"][self.header_rows + 1]:
+            if source_cell.data_type == 'f':
+                like = WriteOnlyCell(self.detailed)
+                copy_style(source_cell, like)
+                self.detail_formulas.append(
+                    (source_cell.column, source_cell.column_letter,
+                     Translator(source_cell.value, source_cell.coordinate),
+                     like))
+        self.detail_end = source["Detailed"].max_row
+        self.detail_row = self.header_rows + 1
+
+    def copy_sheet(self, source):
+        """
+        Creates a streaming sheet laid out like the template sheet and writes
+        its header rows.
+        """
+        from copy import copy
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.worksheet.dimensions import ColumnDimension, \
+            RowDimension
+
+        ws = self.wb.create_sheet(source.title)
+        for key, dim in source.column_dimensions.items():
+            ws.column_dimensions[key] = ColumnDimension(
+                ws, index=key, width=dim.width, bestFit=dim.bestFit,
+                hidden=dim.hidden, outlineLevel=dim.outlineLevel,
+                collapsed=dim.collapsed, min=dim.min, max=dim.max,
+                customWidth=dim.customWidth)
+            copy_style(dim, ws.column_dimensions[key])
+        for key, dim in source.row_dimensions.items():
+            ws.row_dimensions[key] = RowDimension(
+                ws, index=key, ht=dim.ht, customHeight=dim.customHeight,
+                hidden=dim.hidden, outlineLevel=dim.outlineLevel,
+                collapsed=dim.collapsed)
+            if dim.has_style:
+                copy_style(dim, ws.row_dimensions[key])
+
+        ws.sheet_format = copy(source.sheet_format)
+        ws.sheet_properties = copy(source.sheet_properties)
+        ws.views = copy(source.views)
+        ws.freeze_panes = source.freeze_panes
+        ws.auto_filter.ref = source.auto_filter.ref
+        ws.print_options = copy(source.print_options)
+        ws.page_margins = copy(source.page_margins)
+        ws.page_setup = copy(source.page_setup)
+        ws.print_title_rows = source.print_title_rows
+        for merged in source.merged_cells.ranges:
+            ws.merged_cells.add(copy(merged))
+        for formats in source.conditional_formatting:
+            for rule in formats.rules:
+                ws.conditional_formatting.add(str(formats.sqref), rule)
+
+        for source_row in source.iter_rows(max_row=self.header_rows):
+            row = list()
+            for source_cell in source_row:
+                cell = WriteOnlyCell(ws, source_cell.value)
+                if source_cell.has_style:
+                    copy_style(source_cell, cell)
+                row.append(cell)
+            ws.append(row)
+        return ws
+
+    def cell(self, ws, value, like):
+        """
+        Returns a cell holding value with the same style as the cell like.
+        """
+        from copy import copy
+        from openpyxl.cell import WriteOnlyCell
+
+        cell = WriteOnlyCell(ws, value)
+        cell._style = copy(like._style)
+        return cell
+
+    def add_summary(self, row_entries):
+        """
+        Adds a row to the Summary sheet: CustomerCode, Exclude, TotalOwing,
+        AlertNotes and any aged balances.
+        """
+        self.summary.append(
+            [self.cell(self.summary, entry,
+                       self.amount if column > 4 else self.entry)
+             for column, entry in enumerate(row_entries, start=1)])
+
+    def add_detail(self, row_entries):
+        """
+        Adds an invoice row to the Detailed sheet, followed by the template's
+        formulas for that row.
+        """
+        row = [self.cell(self.detailed, entry, self.entry)
+               for entry in row_entries]
+        self.detailed.append(row + self.detail_formula_cells(len(row)))
+        self.detail_row += 1
+
+    def detail_formula_cells(self, filled):
+        """
+        Returns the template's formula cells for the current Detailed row,
+        padded out from column filled.
+        """
+        cells = list()
+        for column, letter, translator, like in self.detail_formulas:
+            while filled + len(cells) < column - 1:
+                cells.append(None)
+            formula = translator.translate_formula(f'{letter}{self.detail_row}')
+            cells.append(self.cell(self.detailed, formula, like))
+        return cells
+
+    def save(self, path):
+        # Finish the template's formula rows below the last invoice
+        while self.detail_row <= self.detail_end:
+            self.detailed.append(self.detail_formula_cells(0))
+            self.detail_row += 1
+        self.wb.save(path)
+
+
+def copy_style(source, target):
+    """
+    Copies the font, fill, border, alignment, number format and protection
+    of a template cell or dimension into a cell of another workbook.
+    """
+    from copy import copy
+
+    target.font = copy(source.font)
+    target.fill = copy(source.fill)
+    target.border = copy(source.border)
+    target.alignment = copy(source.alignment)
+    target.number_format = source.number_format
+    target.protection = copy(source.protection)
 
 
 def email_log(attachment_file=None,
               filename="SyrinxLog",
-              body=config.get("EMAIL", "body").replace("\\n", "\n"),
-              subject=config.get("EMAIL", "subject")):
+              body=None,
+              subject=None):
     import smtplib
     import ssl
     from email.message import EmailMessage
     context = ssl.create_default_context()
 
+    # Defaults are read when sending, so importing this module needs no
+    # [EMAIL] settings
+    if body is None:
+        body = config.get("EMAIL", "body").replace("\\n", "\n")
+    if subject is None:
+        subject = config.get("EMAIL", "subject")
+
     server = config.get("EMAIL", "server")
 
     message = EmailMessage()
@@ -108,9 +370,10 @@ def email_log(attachment_file=None,
         print(e)
 
     # Send the email
-    server = smtplib.SMTP(server, port=587)
-    server.starttls(context=context)
-    server.login(config.get("EMAIL", "login_id"),
-                 config.get("EMAIL", "login_pw"))
-    server.send_message(message)
-    server.quit()
+    with RunMetrics.metrics.timer('email_seconds'):
+        server = smtplib.SMTP(server, port=587)
+        server.starttls(context=context)
+        server.login(config.get("EMAIL", "login_id"),
+                     config.get("EMAIL", "login_pw"))
+        server.send_message(message)
+        server.quit()
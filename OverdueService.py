@@ -0,0 +1,209 @@
+import SetOverdue as Go
+import Settings
+import datetime
+import json
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEBUG = False
+ERROR_PREFIX = '>> Error from OverdueService >> '
+MSG_PREFIX = 'Message from OverdueService >> '
+
+# Resident overdue service:
+# > Start: main.py --service
+# > Runs at the [SERVICE] times, keeping the MYOB session, token and Syrinx
+#   connection open between runs
+# > Status: GET http://127.0.0.1:8765/health
+
+config = Settings.config
+
+# INTEGER REPRESENTATION OF DAY
+day_number = {"Monday": 0,
+              "Tuesday": 1,
+              "Wednesday": 2,
+              "Thursday": 3,
+              "Friday": 4,
+              "Saturday": 5,
+              "Sunday": 6}
+
+
+class Schedule:
+    """
+    Run times of day on chosen days of the week, e.g. days 'Monday, Friday'
+    and times '07:00, 12:30'. '*' for days means every day.
+    """
+
+    def __init__(self, days, times):
+        if days.strip() == '*':
+            self.days = set(range(7))
+        else:
+            self.days = {day_number[day.strip()] for day in days.split(',')}
+        self.times = sorted(datetime.datetime.strptime(value.strip(),
+                                                       '%H:%M').time()
+                            for value in times.split(','))
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.get('SERVICE', 'days', fallback='*'),
+                   config.get('SERVICE', 'times', fallback='07:00'))
+
+    def next_run(self, after):
+        """
+        Returns the first scheduled time later than after.
+        """
+        for offset in range(8):
+            date = after.date() + datetime.timedelta(days=offset)
+            if date.weekday() not in self.days:
+                continue
+            for time_of_day in self.times:
+                run_at = datetime.datetime.combine(date, time_of_day)
+                if run_at > after:
+                    return run_at
+        return None
+
+
+class OverdueService:
+    """
+    Runs SetOverdue.run_cycle on a schedule, leaving the Syrinx connection
+    open between runs along with the MYOB session and token. The connection
+    is checked before each run, and a failed run closes it, so the next run
+    reconnects after a server restart or dropped connection. The status of the
+    service and its last run is served as JSON on a local port.
+    """
+
+    def __init__(self, cycle, schedule=None):
+        self.cycle = dict(cycle, close=False)
+        self.schedule = schedule if schedule is not None \
+            else Schedule.from_config()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.server = None
+        self.status = {'started': now_text(),
+                       'running': False,
+                       'runs': 0,
+                       'failures': 0,
+                       'last_start': None,
+                       'last_end': None,
+                       'last_result': None,
+                       'last_error': None,
+                       'next_run': None}
+
+    def run_once(self):
+        """
+        Runs one overdue cycle and records its result in the status.
+        """
+        with self.lock:
+            self.status['running'] = True
+            self.status['last_start'] = now_text()
+
+        result = 'ok'
+        error = None
+        try:
+            Go.context.check()
+            summary = Go.run_cycle(**self.cycle)
+            if not any(value[1] for value in summary.values()):
+                result = 'no invoices'
+        except Exception as e:
+            result = 'error'
+            error = str(e)
+            print(ERROR_PREFIX + error)
+            if DEBUG:
+                traceback.print_exc()
+            Go.context.close()
+
+        with self.lock:
+            self.status['running'] = False
+            self.status['runs'] += 1
+            self.status['last_end'] = now_text()
+            self.status['last_result'] = result
+            self.status['last_error'] = error
+            if result == 'error':
+                self.status['failures'] += 1
+
+    def health(self):
+        """
+        Returns the service status, with the MYOB connection reuse figures
+        once a run has used the session.
+        """
+        with self.lock:
+            status = dict(self.status)
+        status['myob_connections'] = Go.context.myob_stats()
+        status['syrinx_connected'] = Go.context.connected()
+        return status
+
+    def start_health_server(self):
+        """
+        Serves the status at /health on the host and port set in the
+        [SERVICE] section of settings.ini (default 127.0.0.1:8765). The
+        response is 503 if the last run failed.
+        """
+        self.server = ThreadingHTTPServer(
+            (config.get('SERVICE', 'host', fallback='127.0.0.1'),
+             config.getint('SERVICE', 'port', fallback=8765)),
+            HealthHandler)
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        print(MSG_PREFIX + 'Health endpoint on http://%s:%d/health'
+              % self.server.server_address[0:2])
+
+    def serve(self):
+        """
+        Runs until stopped or interrupted, waiting for each scheduled time.
+        With run_on_start set in [SERVICE], runs once straight away.
+        """
+        self.start_health_server()
+        if config.getboolean('SERVICE', 'run_on_start', fallback=False):
+            self.run_once()
+
+        try:
+            while not self.stopping.is_set():
+                run_at = self.schedule.next_run(datetime.datetime.now())
+                if run_at is None:
+                    print(ERROR_PREFIX + 'No run days or times scheduled.')
+                    break
+                with self.lock:
+                    self.status['next_run'] = run_at.isoformat(
+                        timespec='seconds')
+                print(MSG_PREFIX + f'Next run at {run_at:%Y-%m-%d %H:%M}')
+
+                wait = (run_at - datetime.datetime.now()).total_seconds()
+                if self.stopping.wait(max(wait, 0)):
+                    break
+                self.run_once()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        Go.context.close()
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/health'):
+            self.send_error(404)
+            return
+        status = self.server.service.health()
+        body = json.dumps(status, indent=4).encode('utf-8')
+        self.send_response(503 if status['last_result'] == 'error' else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if DEBUG:
+            super().log_message(format, *args)
+
+
+def now_text():
+    return datetime.datetime.now().isoformat(timespec='seconds')
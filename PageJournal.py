@@ -0,0 +1,251 @@
+import Settings
+import datetime
+import glob
+import hashlib
+import json
+import os
+import time
+
+DEBUG = False
+MSG_PREFIX = 'Message from PageJournal >> '
+
+# Raw MYOB pages written to disk as they arrive, one JSON line per page:
+# > Journal a pull: app.iter_pages('overdue', journal=True)
+# > Replay a finished pull offline: PageJournal.latest().items()
+
+config = Settings.config
+curpath = Settings.curpath
+
+
+def journal_folder():
+    return os.path.join(curpath, config.get('JOURNAL', 'path',
+                                            fallback='journal'))
+
+
+def resume_seconds():
+    # Older pulls are not resumed, as invoices paid or added since would
+    # shift the pages still to fetch
+    return config.getfloat('JOURNAL', 'resume_minutes', fallback=60) * 60
+
+
+class PageJournal:
+    """
+    JSON Lines journal of the raw pages of one MYOB query. The first line
+    records the query, its company file and when it started, each following
+    line a page and the item offset it
+    starts at, and a last line marks the pull as complete. A journal left
+    by an interrupted pull tells iter_pages where to resume, if it started
+    within resume_minutes in the [JOURNAL] section of settings.ini, and a
+    complete one can be replayed without contacting MYOB.
+    """
+
+    def __init__(self, path, query=None, file_id=None):
+        self.path = path
+        self.query = query
+        self.file_id = file_id
+        self.started = None
+        self.offset = 0
+        self.page_size = None
+        self.count = None
+        self.last_page = None
+        self.complete = False
+        self.load()
+
+    @classmethod
+    def for_query(cls, query, file_id=None):
+        """
+        Returns the journal for the query URL to company file file_id, named
+        by a hash of the query in the folder set by path in the [JOURNAL]
+        section of settings.ini.
+        """
+        key = hashlib.sha1(query.encode('utf-8')).hexdigest()[0:16]
+        return cls(os.path.join(journal_folder(), key + '.jsonl'), query,
+                   file_id)
+
+    def load(self):
+        """
+        Reads the journal back to find the offset and last page to resume
+        from. A line cut short by a crash is dropped from the file.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        good_end = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good_end += len(line)
+                self.read_entry(entry)
+
+        if good_end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as file:
+                file.truncate(good_end)
+
+    def read_entry(self, entry):
+        if 'query' in entry:
+            self.query = entry['query']
+            self.file_id = entry.get('file_id', self.file_id)
+            self.started = started_at(entry)
+        elif 'page' in entry:
+            page = entry['page']
+            if self.page_size is None:
+                self.page_size = len(page['Items'])
+            if page.get('Count') is not None:
+                self.count = int(page['Count'])
+            self.offset = entry['offset'] + len(page['Items'])
+            self.last_page = page
+        elif entry.get('complete'):
+            self.complete = True
+
+    def resume_point(self):
+        """
+        Returns (offset, page size, count, last page) for an interrupted pull,
+        or None if the pull must start from the first page.
+        """
+        if self.complete or self.last_page is None:
+            return None
+        if self.started is None \
+                or time.time() - self.started > resume_seconds():
+            return None
+        return self.offset, self.page_size, self.count, self.last_page
+
+    def start(self):
+        """
+        Begins a new journal for the query, replacing any earlier pull.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.offset = 0
+        self.page_size = None
+        self.count = None
+        self.last_page = None
+        self.complete = False
+        self.started = time.time()
+        with open(self.path, 'w') as file:
+            file.write(json.dumps({'query': self.query,
+                                   'file_id': self.file_id,
+                                   'started': datetime.datetime
+                                  .fromtimestamp(self.started)
+                                  .isoformat()}) + '\n')
+
+    def record(self, page):
+        """
+        Appends a raw MYOB page. The line is flushed to disk before the page
+        is passed on, so it survives the process being killed.
+        """
+        entry = {'offset': self.offset, 'page': page}
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.read_entry(entry)
+
+    def finish(self):
+        """
+        Marks the pull as complete and deletes the older journals of the
+        same company file that it replaces (see prune).
+        """
+        with open(self.path, 'a') as file:
+            file.write(json.dumps({'complete': True,
+                                   'items': self.offset}) + '\n')
+        self.complete = True
+        if DEBUG:
+            print(MSG_PREFIX + f'{self.offset} items journalled to '
+                               f'{self.path}')
+        prune(self.path, self.file_id)
+
+    def pages(self):
+        """
+        Yields the items of each journalled page in order, reading the file
+        a line at a time.
+        """
+        with open(self.path, 'r') as file:
+            for line in file:
+                entry = json.loads(line)
+                if 'page' in entry:
+                    yield entry['page']['Items']
+
+    def items(self):
+        for page in self.pages():
+            yield from page
+
+
+def started_at(header):
+    """
+    Returns the start of the pull recorded in a journal's first line, in
+    seconds since the epoch, or None if it is not recorded.
+    """
+    try:
+        return datetime.datetime.fromisoformat(header['started']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def read_header(path):
+    """
+    Returns the first line of a journal, or None if it cannot be read.
+    """
+    try:
+        with open(path, 'r') as file:
+            return json.loads(file.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def is_complete(path):
+    """
+    Returns True if the journal ends with the line marking a complete pull,
+    reading only the end of the file so a journal still being written is
+    left untouched.
+    """
+    with open(path, 'rb') as file:
+        file.seek(max(os.path.getsize(path) - 256, 0))
+        lines = file.read().splitlines()
+    try:
+        return bool(lines) and bool(json.loads(lines[-1]).get('complete'))
+    except ValueError:
+        return False
+
+
+def prune(keep, file_id=None):
+    """
+    Deletes every complete journal of company file file_id other than the
+    one at keep, as only the latest is replayed. The cutoff date is part of
+    each query, so a new journal is written each day; interrupted journals
+    too old to resume are deleted too. Journals of other company files are
+    left alone, as a multi-file run finishes one journal per file.
+    """
+    stale = time.time() - resume_seconds()
+    for path in glob.glob(os.path.join(journal_folder(), '*.jsonl')):
+        if os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        header = read_header(path)
+        # Journals written before file IDs were recorded belong to any file
+        if header is None or header.get('file_id', file_id) != file_id:
+            continue
+        started = started_at(header)
+        try:
+            if is_complete(path) or started is None or started < stale:
+                os.remove(path)
+                if DEBUG:
+                    print(MSG_PREFIX + f'Deleted old journal {path}')
+        except OSError as e:
+            print(MSG_PREFIX + f'Could not delete journal {path}: {e}')
+
+
+def latest():
+    """
+    Returns the most recently written complete journal, or None if there
+    is none.
+    """
+    paths = sorted(glob.glob(os.path.join(journal_folder(), '*.jsonl')),
+                   key=os.path.getmtime, reverse=True)
+    for path in paths:
+        journal = PageJournal(path)
+        if journal.complete:
+            return journal
+    return None
@@ -0,0 +1,224 @@
+import Settings
+import datetime
+import json
+import os
+import threading
+import time
+
+DEBUG = False
+ERROR_PREFIX = '>> Error from RunMetrics >> '
+MSG_PREFIX = 'Message from RunMetrics >> '
+
+# Counters and timings for one overdue run:
+# > Count: metrics.count('myob_pages') / metrics.count('sql_rows_read', 40)
+# > Time: with metrics.timer('sql_seconds', op='read'): ...
+# > Write the JSON report and Prometheus textfile: metrics.write(stamp)
+
+config = Settings.config
+
+# Prefix of every metric in the Prometheus textfile
+PREFIX = 'overdue_'
+
+# Upper bounds (seconds) of the timing histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Help text for each metric
+DESCRIPTIONS = {
+    'myob_requests': 'MYOB and token HTTP requests sent, including retries.',
+    'myob_request_seconds': 'Time taken by each MYOB HTTP request.',
+    'myob_bytes_received': 'Bytes of MYOB response bodies received.',
+    'myob_responses': 'MYOB HTTP responses by status code.',
+    'myob_retries': 'MYOB requests retried after a throttle, server error '
+                    'or dropped connection.',
+    'myob_pages': 'Pages of MYOB results received.',
+    'myob_items': 'Items received in MYOB pages.',
+    'myob_token_refreshes': 'MYOB access token refreshes.',
+    'sql_seconds': 'Time taken by each SyrinxEH query or update.',
+    'sql_rows_read': 'Rows read from SyrinxEH.',
+    'sql_rows_written': 'Rows updated in SyrinxEH.',
+    'stage_seconds': 'Time taken by each stage of the run.',
+    'excel_seconds': 'Time taken to write the Excel log.',
+    'email_seconds': 'Time taken to email the Excel log.',
+}
+
+
+class Timer:
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started,
+                             **self.labels)
+
+
+class RunMetrics:
+    """
+    Counters and timing histograms gathered from every module during a run.
+    Each metric is kept per set of labels, e.g. sql_seconds for op='read'
+    and op='write'. Safe to update from the page and Syrinx worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.started = None
+        self.reset()
+
+    def reset(self):
+        """
+        Clears every metric, ready for a new run.
+        """
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+            self.started = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                             'buckets': [0] * len(BUCKETS)}
+                self.histograms[key] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager that adds the time spent inside it to the
+        named histogram.
+        """
+        return Timer(self, name, labels)
+
+    def report(self):
+        """
+        Returns the metrics of the run as a dictionary for the JSON report.
+        """
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels),
+                         'value': value}
+                        for (name, labels), value in self.counters.items()]
+            timings = [{'name': name, 'labels': dict(labels),
+                        'count': histogram['count'],
+                        'sum': round(histogram['sum'], 6),
+                        'mean': round(histogram['sum'] / histogram['count'],
+                                      6),
+                        'max': round(histogram['max'], 6),
+                        'buckets': dict(zip([str(bound) for bound in BUCKETS],
+                                            histogram['buckets']))}
+                       for (name, labels), histogram
+                       in self.histograms.items()]
+        finished = time.time()
+        return {'started': timestamp(self.started),
+                'finished': timestamp(finished),
+                'seconds': round(finished - self.started, 3),
+                'counters': sorted(counters, key=sort_key),
+                'timings': sorted(timings, key=sort_key)}
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format. Values
+        cover the last run only, so counters are written as gauges.
+        """
+        lines = list()
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {PREFIX}{name} '
+                             f'{DESCRIPTIONS.get(name, name)}')
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        for (name, labels), value in counters:
+            describe(name, 'gauge')
+            lines.append(f'{PREFIX}{name}{label_text(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            describe(name, 'histogram')
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append(f'{PREFIX}{name}_bucket'
+                             f'{label_text(labels + (("le", bound),))} '
+                             f'{count}')
+            lines.append(f'{PREFIX}{name}_bucket'
+                         f'{label_text(labels + (("le", "+Inf"),))} '
+                         f'{histogram["count"]}')
+            lines.append(f'{PREFIX}{name}_sum{label_text(labels)} '
+                         f'{histogram["sum"]:.6f}')
+            lines.append(f'{PREFIX}{name}_count{label_text(labels)} '
+                         f'{histogram["count"]}')
+
+        lines.append(f'# HELP {PREFIX}last_run_timestamp_seconds '
+                     f'When the last run finished.')
+        lines.append(f'# TYPE {PREFIX}last_run_timestamp_seconds gauge')
+        lines.append(f'{PREFIX}last_run_timestamp_seconds {time.time():.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, stamp):
+        """
+        Writes the JSON report as metrics_<stamp>.json in folder_location and
+        the Prometheus textfile to textfile in the [METRICS] section of
+        settings.ini (default overdue.prom in folder_location), for the node
+        exporter's textfile collector. Returns the JSON report's file name.
+        """
+        folder = config.get('DEFAULT', 'folder_location', fallback='')
+        filename = 'metrics_' + stamp + '.json'
+        with open(folder + filename, 'w') as file:
+            json.dump(self.report(), file, indent=4)
+
+        textfile = config.get('METRICS', 'textfile', fallback='') \
+            or folder + 'overdue.prom'
+        # Replaced in one step so the collector never reads half a file
+        with open(textfile + '.tmp', 'w', newline='\n') as file:
+            file.write(self.prometheus())
+        os.replace(textfile + '.tmp', textfile)
+
+        if DEBUG:
+            print(MSG_PREFIX + f'Metrics written to {filename} and {textfile}')
+        return filename
+
+
+def label_key(labels):
+    # Values are kept as text, so a status of 200 and one of 'error' sort
+    # together
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def sort_key(entry):
+    return entry['name'], sorted(entry['labels'].items())
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds).isoformat(
+        timespec='seconds')
+
+
+# Metrics of the current run, shared by every module
+metrics = RunMetrics()
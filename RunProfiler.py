@@ -0,0 +1,175 @@
+import RunMetrics
+import Settings
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+DEBUG = False
+ERROR_PREFIX = '>> Error from RunProfiler >> '
+MSG_PREFIX = 'Message from RunProfiler >> '
+
+# Profiling of each stage of a run (main.py --profile):
+# > with profiler.stage('get_overdue'): ...
+# > Per stage, in folder_location:
+#   profile_<ts>_<stage>.pstats     cProfile of the calling thread, for
+#                                   pstats or snakeviz
+#   profile_<ts>_<stage>.collapsed  sampled stacks of every thread, for
+#                                   flamegraph.pl or speedscope
+# > profile_<ts>.json: wall and CPU time, memory peak and top allocations
+#   of each stage
+
+config = Settings.config
+
+
+class StackSampler:
+    """
+    Samples the stack of every other thread at a fixed interval and counts
+    each distinct stack, root first, under the thread's name. Unlike
+    cProfile, this sees the page, log and Syrinx worker threads as well.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = dict()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='profile-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        names = dict()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == self.thread.ident:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name
+                             for thread in threading.enumerate()}
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({os.path.basename(code.co_filename)}:'
+                                 f'{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f'{stack} {count}\n')
+
+
+class StageProfile:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+        self.sampler = None
+        self.started = None
+        self.cpu_started = None
+
+    def __enter__(self):
+        import cProfile
+        import tracemalloc
+
+        self.sampler = StackSampler(self.profiler.interval)
+        self.sampler.start()
+        tracemalloc.start(self.profiler.frames)
+        self.profile = cProfile.Profile()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        import tracemalloc
+
+        self.profile.disable()
+        wall = time.perf_counter() - self.started
+        cpu = time.process_time() - self.cpu_started
+        self.sampler.stop()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        RunMetrics.metrics.observe('stage_seconds', wall, stage=self.name)
+        try:
+            self.profiler.record(self, wall, cpu, peak, snapshot)
+        except Exception as e:
+            print(ERROR_PREFIX + str(e))
+
+
+class RunProfiler:
+    """
+    Profiles each stage of a run with cProfile, a stack sampler and
+    tracemalloc, and writes the results next to the logs. The sample
+    interval and the number of allocation sites reported are read from the
+    [PROFILE] section of settings.ini. Profiling slows a run down, tracemalloc
+    most of all, so times are for comparing stages rather than runs.
+    """
+
+    def __init__(self, stamp=None):
+        if stamp is None:
+            stamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        self.stamp = stamp
+        self.folder = config.get('DEFAULT', 'folder_location', fallback='')
+        self.interval = config.getfloat('PROFILE', 'sample_ms',
+                                        fallback=5) / 1000
+        self.top = config.getint('PROFILE', 'top_allocations', fallback=10)
+        self.frames = config.getint('PROFILE', 'traceback_frames',
+                                    fallback=1)
+        self.stages = list()
+        self.filenames = list()
+
+    def stage(self, name):
+        """
+        Returns a context manager that profiles the code inside it as the
+        named stage.
+        """
+        return StageProfile(self, name)
+
+    def record(self, stage, wall, cpu, peak, snapshot):
+        prefix = 'profile_' + self.stamp + '_' + stage.name
+        stage.profile.dump_stats(self.folder + prefix + '.pstats')
+        stage.sampler.write(self.folder + prefix + '.collapsed')
+        self.filenames.extend([prefix + '.pstats', prefix + '.collapsed'])
+
+        allocations = [{'site': str(stat.traceback),
+                        'kb': round(stat.size / 1024, 1),
+                        'blocks': stat.count}
+                       for stat in snapshot.statistics('lineno')[0:self.top]]
+        self.stages.append({'stage': stage.name,
+                            'wall_seconds': round(wall, 4),
+                            'cpu_seconds': round(cpu, 4),
+                            'peak_mb': round(peak / 1024 ** 2, 2),
+                            'samples': sum(stage.sampler.stacks.values()),
+                            'top_allocations': allocations})
+        print(MSG_PREFIX + f'{stage.name}: {wall:.3f}s wall, {cpu:.3f}s CPU, '
+                           f'{peak / 1024 ** 2:.1f} MB peak')
+
+    def write(self):
+        """
+        Writes the summary of every stage profiled and returns the names of
+        all the profile files.
+        """
+        filename = 'profile_' + self.stamp + '.json'
+        with open(self.folder + filename, 'w') as file:
+            json.dump({'stamp': self.stamp, 'stages': self.stages}, file,
+                      indent=4)
+        print(MSG_PREFIX + "Profiles stored in '"
+              + "', '".join(self.filenames + [filename])
+              + "' located in folder " + self.folder)
+        return self.filenames + [filename]
@@ -0,0 +1,370 @@
+import Settings
+import bisect
+import csv
+import datetime
+import json
+import os
+import re
+import sqlite3
+
+DEBUG = False
+MSG_PREFIX = 'Message from RunStore >> '
+
+# Local SQLite history of every overdue run:
+# > Save a run: RunStore().save(stamp, overdue_customers, table, days_over)
+# > Load runs from existing logs: RunStore().import_logs(folder)
+# > Reports: trend(display_id), first_seen(), overdue_since(display_id),
+#   balance_delta(), invoice_history(number)
+# > Runs older than keep_days in [HISTORY] are deleted as each run is saved
+
+config = Settings.config
+curpath = Settings.curpath
+
+# Run stamps as used in log file names, e.g. 2021-03-01-070002
+STAMP_FORMAT = "%Y-%m-%d-%H%M%S"
+LOG_NAME = re.compile(r'log_(\d{4}-\d\d-\d\d-\d{6})_(summary|detailed)\.txt$')
+
+# Detailed logs are matched to the summary written at most this long after
+# them, as logs from before the LogPipeline were stamped separately
+LOG_PAIRING = datetime.timedelta(hours=1)
+
+
+class RunStore:
+    """
+    Per-customer summaries and per-invoice details of each run, indexed by
+    customer, run and invoice number so reports across runs are single
+    indexed queries rather than scans of the log files. Runs are identified
+    by the stamp used in their log file names.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(curpath, config.get('HISTORY', 'path',
+                                                    fallback='history.db'))
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                        'run_id INTEGER PRIMARY KEY, '
+                        'stamp TEXT NOT NULL UNIQUE, '
+                        'days_over INTEGER, '
+                        'customers INTEGER, '
+                        'invoices INTEGER, '
+                        'total REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS summaries ('
+                        'run_id INTEGER NOT NULL, '
+                        'display_id TEXT NOT NULL, '
+                        'name TEXT, '
+                        'excluded INTEGER, '
+                        'total REAL, '
+                        'notes TEXT, '
+                        'aging TEXT, '
+                        'PRIMARY KEY (display_id, run_id))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS summaries_run '
+                        'ON summaries (run_id, total)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS details ('
+                        'run_id INTEGER NOT NULL, '
+                        'number TEXT, '
+                        'display_id TEXT, '
+                        'date TEXT, '
+                        'due_date TEXT, '
+                        'balance REAL, '
+                        'total REAL, '
+                        'memo TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS details_number '
+                        'ON details (number, run_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS details_customer '
+                        'ON details (display_id, run_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS details_run '
+                        'ON details (run_id)')
+        self.db.commit()
+
+    def add_run(self, stamp, days_over, summaries, details, replace=True):
+        """
+        Stores a run from (display_id, name, excluded, total, notes, aging)
+        summary rows and (number, display_id, date, due_date, balance, total,
+        memo) detail rows, replacing any run with the same stamp. With
+        replace unset, a run stamped in the same second as an earlier one is
+        kept alongside it, as stamp.2, stamp.3 and so on. Dates are ISO dates.
+        Returns the run ID.
+        """
+        with self.db:
+            old = self.db.execute('SELECT run_id FROM runs WHERE stamp = ?',
+                                  (stamp,)).fetchone()
+            if old is not None and not replace:
+                stamp = self.unique_stamp(stamp)
+            elif old is not None:
+                self.db.execute('DELETE FROM summaries WHERE run_id = ?', old)
+                self.db.execute('DELETE FROM details WHERE run_id = ?', old)
+                self.db.execute('DELETE FROM runs WHERE run_id = ?', old)
+
+            run_id = self.db.execute(
+                'INSERT INTO runs (stamp, days_over, customers, invoices, '
+                'total) VALUES (?, ?, ?, ?, ?)',
+                (stamp, days_over, 0, 0, 0.0)).lastrowid
+            self.db.executemany('INSERT INTO summaries VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?)',
+                                ((run_id,) + tuple(row) for row in summaries))
+            self.db.executemany('INSERT INTO details VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?)',
+                                ((run_id,) + tuple(row) for row in details))
+            self.db.execute('UPDATE runs SET '
+                            'customers = (SELECT COUNT(*) FROM summaries '
+                            'WHERE run_id = ? AND total > 0), '
+                            'invoices = (SELECT COUNT(*) FROM details '
+                            'WHERE run_id = ?), '
+                            'total = (SELECT COALESCE(SUM(total), 0) '
+                            'FROM summaries WHERE run_id = ?) '
+                            'WHERE run_id = ?',
+                            (run_id, run_id, run_id, run_id))
+
+        if DEBUG:
+            print(MSG_PREFIX + f'Run {stamp} stored as run {run_id}.')
+        return run_id
+
+    def unique_stamp(self, stamp):
+        count = 2
+        while self.db.execute('SELECT 1 FROM runs WHERE stamp = ?',
+                              (f'{stamp}.{count}',)).fetchone():
+            count += 1
+        return f'{stamp}.{count}'
+
+    def save(self, stamp, overdue_customers, table, days_over=None):
+        """
+        Stores a run from the customer summary and InvoiceTable returned by
+        SetOverdue.get_overdue, never replacing an earlier run, then deletes
+        runs older than keep_days (see prune).
+        """
+        import numpy as np
+
+        names = dict(zip(table.customers, table.names))
+        summaries = [(key, names.get(key), value[0], value[1], value[2],
+                      json.dumps(value[3]) if value[3] else None)
+                     for key, value in overdue_customers.items()]
+        details = zip(table.number,
+                      [table.customers[code] for code in table.code.tolist()],
+                      np.datetime_as_string(table.date).tolist(),
+                      np.datetime_as_string(table.due_date).tolist(),
+                      table.balance.tolist(),
+                      table.total.tolist(),
+                      table.memo)
+        run_id = self.add_run(stamp, days_over, summaries, details,
+                              replace=False)
+        self.prune()
+        return run_id
+
+    def prune(self, keep_days=None):
+        """
+        Deletes the runs stamped more than keep_days ago (default keep_days
+        in the [HISTORY] section of settings.ini, 0 to keep every run) and
+        returns the number deleted.
+        """
+        if keep_days is None:
+            keep_days = config.getint('HISTORY', 'keep_days', fallback=365)
+        if keep_days <= 0:
+            return 0
+        cutoff = (datetime.datetime.now()
+                  - datetime.timedelta(days=keep_days)).strftime(STAMP_FORMAT)
+        with self.db:
+            old = 'SELECT run_id FROM runs WHERE stamp < ?'
+            self.db.execute(f'DELETE FROM summaries WHERE run_id IN ({old})',
+                            (cutoff,))
+            self.db.execute(f'DELETE FROM details WHERE run_id IN ({old})',
+                            (cutoff,))
+            deleted = self.db.execute('DELETE FROM runs WHERE stamp < ?',
+                                      (cutoff,)).rowcount
+        if DEBUG and deleted:
+            print(MSG_PREFIX + f'{deleted} runs before {cutoff} deleted.')
+        return deleted
+
+    def import_logs(self, folder=None):
+        """
+        Stores the runs recorded in the summary and detailed logs in folder
+        (default folder_location) and returns the number of runs stored.
+        Each detailed log is stored with the first summary log stamped
+        within LOG_PAIRING after it. Due dates and names are not in the
+        logs, so are left empty.
+        """
+        if folder is None:
+            folder = config.get('DEFAULT', 'folder_location', fallback='')
+        folder = folder or '.'
+
+        logs = {'summary': dict(), 'detailed': dict()}
+        for filename in os.listdir(folder):
+            match = LOG_NAME.match(filename)
+            if match:
+                logs[match.group(2)][match.group(1)] = \
+                    os.path.join(folder, filename)
+
+        stamps = sorted(logs['summary'])
+        paired = dict()
+        for stamp in sorted(logs['detailed']):
+            i = bisect.bisect_left(stamps, stamp)
+            if i < len(stamps) and parse_stamp(stamps[i]) \
+                    - parse_stamp(stamp) <= LOG_PAIRING:
+                paired[stamps[i]] = logs['detailed'][stamp]
+
+        for stamp in stamps:
+            details = list()
+            if stamp in paired:
+                details = read_detailed_log(paired[stamp])
+            self.add_run(stamp, None, read_summary_log(logs['summary'][stamp]),
+                         details)
+
+        print(MSG_PREFIX + f'{len(stamps)} runs imported from {folder}.')
+        return len(stamps)
+
+    def runs(self):
+        """
+        Returns (stamp, days_over, customers overdue, invoices, total owing)
+        for every run, oldest first.
+        """
+        return self.db.execute('SELECT stamp, days_over, customers, invoices, '
+                               'total FROM runs ORDER BY stamp').fetchall()
+
+    def trend(self, display_id):
+        """
+        Returns (stamp, total owing, excluded, aged balances) for the customer
+        in every run that included them, oldest first.
+        """
+        rows = self.db.execute('SELECT r.stamp, s.total, s.excluded, s.aging '
+                               'FROM summaries AS s '
+                               'INNER JOIN runs AS r ON r.run_id = s.run_id '
+                               'WHERE s.display_id = ? '
+                               'ORDER BY r.stamp', (display_id,))
+        return [(row[0], row[1], row[2], json.loads(row[3]) if row[3] else {})
+                for row in rows]
+
+    def first_seen(self, display_id=None):
+        """
+        Returns the stamp of the first run in which the customer was overdue,
+        or None. Without a customer, returns a dictionary of the first stamp
+        for every customer ever overdue.
+        """
+        if display_id is not None:
+            return self.db.execute('SELECT MIN(r.stamp) '
+                                   'FROM summaries AS s '
+                                   'INNER JOIN runs AS r '
+                                   'ON r.run_id = s.run_id '
+                                   'WHERE s.display_id = ? AND s.total > 0',
+                                   (display_id,)).fetchone()[0]
+        return dict(self.db.execute('SELECT s.display_id, MIN(r.stamp) '
+                                    'FROM summaries AS s '
+                                    'INNER JOIN runs AS r '
+                                    'ON r.run_id = s.run_id '
+                                    'WHERE s.total > 0 '
+                                    'GROUP BY s.display_id'))
+
+    def overdue_since(self, display_id):
+        """
+        Returns the stamp of the first run of the customer's current unbroken
+        spell of overdue runs, or None if they were not overdue in the latest
+        run.
+        """
+        latest = self.db.execute('SELECT MAX(stamp) FROM runs').fetchone()[0]
+        # The last run in which the customer owed nothing overdue
+        cleared = self.db.execute('SELECT MAX(r.stamp) FROM runs AS r '
+                                  'LEFT JOIN summaries AS s '
+                                  'ON s.run_id = r.run_id '
+                                  'AND s.display_id = ? '
+                                  'WHERE s.total IS NULL OR s.total <= 0',
+                                  (display_id,)).fetchone()[0]
+        if latest is None or cleared == latest:
+            return None
+        return self.db.execute('SELECT MIN(r.stamp) '
+                               'FROM summaries AS s '
+                               'INNER JOIN runs AS r ON r.run_id = s.run_id '
+                               'WHERE s.display_id = ? AND s.total > 0 '
+                               'AND r.stamp > ?',
+                               (display_id, cleared or '')).fetchone()[0]
+
+    def balance_delta(self, before=None, after=None):
+        """
+        Returns (display_id, total before, total after, change) for each
+        customer whose total owing differs between the runs stamped before
+        and after (default the last two runs), largest increase first.
+        """
+        if before is None or after is None:
+            latest = [row[0] for row in self.db.execute(
+                'SELECT stamp FROM runs ORDER BY stamp DESC LIMIT 2')]
+            if len(latest) < 2:
+                return []
+            after = after or latest[0]
+            before = before or latest[1]
+
+        ids = self.db.execute('SELECT '
+                              '(SELECT run_id FROM runs WHERE stamp = ?), '
+                              '(SELECT run_id FROM runs WHERE stamp = ?)',
+                              (before, after)).fetchone()
+        return self.db.execute('SELECT display_id, '
+                               'SUM(CASE WHEN run_id = ? THEN total '
+                               'ELSE 0 END) AS before_total, '
+                               'SUM(CASE WHEN run_id = ? THEN total '
+                               'ELSE 0 END) AS after_total, '
+                               'SUM(CASE WHEN run_id = ? THEN total '
+                               'ELSE -total END) AS change '
+                               'FROM summaries '
+                               'WHERE run_id IN (?, ?) '
+                               'GROUP BY display_id '
+                               'HAVING ABS(change) >= 0.005 '
+                               'ORDER BY change DESC',
+                               (ids[0], ids[1], ids[1], ids[0], ids[1])
+                               ).fetchall()
+
+    def invoice_history(self, number):
+        """
+        Returns (stamp, display_id, balance, due date) for each run the
+        invoice appeared in, oldest first.
+        """
+        return self.db.execute('SELECT r.stamp, d.display_id, d.balance, '
+                               'd.due_date '
+                               'FROM details AS d '
+                               'INNER JOIN runs AS r ON r.run_id = d.run_id '
+                               'WHERE d.number = ? '
+                               'ORDER BY r.stamp', (number,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def parse_stamp(stamp):
+    return datetime.datetime.strptime(stamp, STAMP_FORMAT)
+
+
+def read_summary_log(path):
+    """
+    Reads a summary log into summary rows for RunStore.add_run. Columns
+    after AlertNotes are aged balances.
+    """
+    with open(path, 'r', newline='') as file:
+        reader = csv.reader(file, delimiter='\t', quotechar='|')
+        header = next(reader, [])
+        labels = header[4:]
+        rows = list()
+        for row in reader:
+            if not row:
+                continue
+            aging = dict(zip(labels, [float(value or 0) for value in row[4:]]))
+            rows.append((row[0], None,
+                         int(float(row[1])) if row[1] else 0,
+                         float(row[2] or 0),
+                         row[3] if len(row) > 3 and row[3] else None,
+                         json.dumps(aging) if aging else None))
+    return rows
+
+
+def read_detailed_log(path):
+    """
+    Reads a detailed log into detail rows for RunStore.add_run, turning
+    its d/m/y dates into ISO dates.
+    """
+    with open(path, 'r', newline='') as file:
+        reader = csv.reader(file, delimiter='\t', quotechar='|')
+        next(reader, None)
+        rows = list()
+        for row in reader:
+            if len(row) < 9:
+                continue
+            date = f'{row[1][6:10]}-{row[1][3:5]}-{row[1][0:2]}'
+            rows.append((row[0], row[2], date, None, float(row[4] or 0),
+                         float(row[7] or 0), row[8]))
+    return rows
@@ -1,251 +1,985 @@
 __author__ = 'Jade McKenzie', 'Tyler McCamley'
 
 import MyobAuth
+import RunMetrics
+import Settings
+import SyrinxSnapshot
 import csv
 import datetime
-import pyodbc
-import configparser
 import os
 import sys
+import threading
 
 DEBUG = False
 
 # Included Tasks:
-# > Clear old information from SyrinxEH database: syrinx_clear()
-# > Get overdue information from MYOB: get_overdue(days_over, min_total)
-# > Set overdue customers in Syrinx: set_overdue(overdue_customers, days_over)
-
-config = configparser.ConfigParser()
-curpath = os.path.dirname(os.path.realpath(sys.argv[0]))
-cfgpath = os.path.join(curpath, 'settings.ini')
-config.read(cfgpath)
+# > Read flagged Syrinx customers once: load_snapshot(cached), or in the
+#   background while MYOB is fetched: start_snapshot(cached)
+# > Clear old information from SyrinxEH database:
+#   syrinx_clear(snapshot, server_side)
+# > Sync the local invoice mirror from MYOB: sync_mirror(parallel)
+# > Get overdue information from MYOB, the mirror or a page journal:
+#   get_overdue(days_over, min_total, parallel=, mirror=, snapshot=,
+#               buckets=, journal=, replay=, sinks=)
+# > Set overdue customers in Syrinx and finish the logs:
+#   set_overdue(overdue_customers, days_over, logs)
+# > Or, in place of clear and set, write only changed customers:
+#   reconcile(overdue_customers, days_over, snapshot, logs)
+# > Or run every step in turn: run_cycle(days_over, min_total, ...)
+# > Refresh a few customers, e.g. once they have paid:
+#   refresh_customers(display_ids, days_over, min_total, buckets)
+# > Keep each run in the local history (RunStore): save_history(overdue, ...)
+
+config = Settings.config
+curpath = Settings.curpath
 
 folder_location = config.get("DEFAULT", "folder_location")
 
-# MYOB Authorisation
-app = MyobAuth.EagleMyobApi()
-
 # Required data for logs
 from_syrinx = ['Alert Notes', 'Prop:ExcludeFromDebtCollecting']
 from_json = ['Number', 'Date', 'DisplayID', 'Name', 'BalanceDueAmount',
              'Subtotal', 'TotalTax', 'TotalAmount', 'JournalMemo']
 
-# Connect to SyrinxEH Database
-connection = pyodbc.connect(r"Driver={SQL Server};"
-                            r"Server=" + config.get("SQL", "server") + r";"
-                            r"Database=" + config.get("SQL", "db") + r";"
-                            r"UID=" + config.get("SQL", "uid") + r";"
-                            r"PWD=" + config.get("SQL", "pwd") + r";"
-                            r"Trusted_Connection="
-                            + config.get("SQL", "trusted") + r";")
-cursor = connection.cursor()
+
+class RunContext:
+    """
+    The MYOB client and SyrinxEH connection used by a run. Neither is created
+    until it is first used, so importing this module, a dry run or a run
+    that stops on a bad config never pays for OAuth setup or a database
+    connection. close() ends the connection; the next use reconnects.
+    """
+
+    def __init__(self):
+        self._app = None
+        self._connection = None
+        self._cursor = None
+        self.lock = threading.Lock()
+
+    @property
+    def app(self):
+        # MYOB Authorisation
+        if self._app is None:
+            self._app = MyobAuth.EagleMyobApi()
+        return self._app
+
+    @property
+    def connection(self):
+        return self.connect()
+
+    @property
+    def cursor(self):
+        self.connect()
+        return self._cursor
+
+    def connect(self):
+        # Connect to SyrinxEH Database
+        with self.lock:
+            if self._connection is None:
+                import pyodbc
+                self._connection = pyodbc.connect(
+                    r"Driver={SQL Server};"
+                    r"Server=" + config.get("SQL", "server") + r";"
+                    r"Database=" + config.get("SQL", "db") + r";"
+                    r"UID=" + config.get("SQL", "uid") + r";"
+                    r"PWD=" + config.get("SQL", "pwd") + r";"
+                    r"Trusted_Connection=" + config.get("SQL", "trusted")
+                    + r";")
+                self._cursor = self._connection.cursor()
+            return self._connection
+
+    def attach(self, connection):
+        """
+        Uses an open DB-API connection, such as the SQLite stand-in in
+        Benchmark, in place of connecting to SyrinxEH.
+        """
+        with self.lock:
+            self._connection = connection
+            self._cursor = connection.cursor()
+
+    def connected(self):
+        return self._connection is not None
+
+    def check(self):
+        """
+        Tests a connection left open by an earlier run with SELECT 1. If the
+        server has dropped it, it is closed so the next use reconnects.
+        Returns True if the connection is usable or none is open.
+        """
+        with self.lock:
+            connection = self._connection
+        if connection is None:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1").fetchall()
+            cursor.close()
+            return True
+        except Exception as e:
+            print(f"Syrinx connection lost, reconnecting: {e}")
+            try:
+                self.close()
+            except Exception:
+                pass
+            return False
+
+    def myob_stats(self):
+        """
+        Returns the MYOB connection reuse figures, or None if the MYOB client
+        has not been used.
+        """
+        if self._app is None:
+            return None
+        return self._app.connection_stats()
+
+    def close(self):
+        with self.lock:
+            try:
+                if self._connection is not None:
+                    self._connection.close()
+            finally:
+                self._connection = None
+                self._cursor = None
+
+
+context = RunContext()
+
+
+def __getattr__(name):
+    # SetOverdue.app, .connection and .cursor are created on first access
+    if name in ('app', 'connection', 'cursor'):
+        return getattr(context, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Background thread for Syrinx queries, see syrinx_worker()
+syrinx_executor = None
+
+# Modules that are only imported once they are needed, never at startup
+DEFERRED_MODULES = ['numpy', 'openpyxl', 'pyodbc', 'requests',
+                    'requests_oauthlib', 'selenium', 'smtplib']
+
+# Staging table for set-based updates of TH_CUSTOMERS. Each staged row holds
+# the new alert text, the new on hold flag (NULL leaves it unchanged) and
+# whether the alert change date and user should be stamped or cleared.
+# #OVERDUE_STATE lives in tempdb, so its text columns take the database's
+# collation to join TH_CUSTOMERS, and the account number is VARCHAR so the
+# join can seek the account number index.
+SQL_CREATE_STAGING = ("IF OBJECT_ID('tempdb..#OVERDUE_STATE') IS NOT NULL "
+                      "DROP TABLE #OVERDUE_STATE; "
+                      "CREATE TABLE #OVERDUE_STATE ("
+                      "CST_ACCOUNT_NUMBER VARCHAR(50) "
+                      "COLLATE DATABASE_DEFAULT NOT NULL, "
+                      "CST_ALERT_TEXT NVARCHAR(4000) "
+                      "COLLATE DATABASE_DEFAULT NULL, "
+                      "CST_ON_HOLD BIT NULL, "
+                      "ALERT_STAMPED BIT NOT NULL)")
+SQL_INSERT_STAGING = "INSERT INTO #OVERDUE_STATE VALUES (?, ?, ?, ?)"
+SQL_APPLY_STAGING = ("UPDATE c SET "
+                     "CST_ALERT_CHG_DATE = CASE WHEN s.ALERT_STAMPED = 1 "
+                     "THEN GETDATE() ELSE NULL END, "
+                     "CST_ALERT_CHG_USERID = CASE WHEN s.ALERT_STAMPED = 1 "
+                     "THEN 16 ELSE NULL END, "
+                     "CST_ALERT_TEXT = s.CST_ALERT_TEXT, "
+                     "CST_ON_HOLD = COALESCE(s.CST_ON_HOLD, c.CST_ON_HOLD) "
+                     "FROM SyrinxEH.dbo.TH_CUSTOMERS AS c "
+                     "INNER JOIN #OVERDUE_STATE AS s "
+                     "ON c.CST_ACCOUNT_NUMBER = s.CST_ACCOUNT_NUMBER")
+SQL_DROP_STAGING = "DROP TABLE #OVERDUE_STATE"
+
+# Customers with existing notes, HoldOverdue status or an on hold flag
+SQL_FLAGGED = ('FROM SyrinxEH.dbo.TH_CUSTOMERS '
+               'WHERE CST_CURRENT_FLAG = 1 '
+               'AND CST_ACCOUNT_NUMBER IS NOT NULL '
+               'AND (CST_ALERT_TEXT IS NOT NULL '
+               'OR CST_PROP2 IS NOT NULL '
+               'OR CST_ON_HOLD = 1)')
+SQL_CUSTOMER_COLUMNS = ('SELECT '
+                        'CST_ACCOUNT_NUMBER, '
+                        'CST_ALERT_TEXT, '
+                        'CST_ON_HOLD, '
+                        'CASE WHEN CST_PROP2 IS NULL THEN 0 ELSE 1 END '
+                        'AS CST_PROP2 ')
+SQL_SELECT_CUSTOMERS = SQL_CUSTOMER_COLUMNS + SQL_FLAGGED
+
+# Given customers, flagged or not; {} is filled with a ? per account
+SQL_SELECT_ACCOUNTS = (SQL_CUSTOMER_COLUMNS +
+                       'FROM SyrinxEH.dbo.TH_CUSTOMERS '
+                       'WHERE CST_CURRENT_FLAG = 1 '
+                       'AND CST_ACCOUNT_NUMBER IN ({})')
+
+# T-SQL version of kept_notes(): everything after '~~' and the following
+# character when the marker is not at the start, otherwise the whole alert.
+SQL_KEPT_NOTES = ("CASE WHEN CHARINDEX('~~', CST_ALERT_TEXT) > 1 "
+                  "THEN STUFF(CST_ALERT_TEXT, 1, "
+                  "CHARINDEX('~~', CST_ALERT_TEXT) + 2, '') "
+                  "ELSE CST_ALERT_TEXT END")
+SQL_SELECT_KEPT_NOTES = ('SELECT '
+                         'CST_ACCOUNT_NUMBER, '
+                         'CST_ALERT_TEXT, '
+                         + SQL_KEPT_NOTES + ' AS KEPT_NOTES ' + SQL_FLAGGED)
+SQL_CLEAR_FLAGGED = ("UPDATE c SET "
+                     "CST_ALERT_CHG_DATE = NULL, "
+                     "CST_ALERT_CHG_USERID = NULL, "
+                     "CST_ALERT_TEXT = CASE WHEN DATALENGTH(f.KEPT_NOTES) = 0 "
+                     "THEN NULL ELSE f.KEPT_NOTES END, "
+                     "CST_ON_HOLD = 0 "
+                     "FROM SyrinxEH.dbo.TH_CUSTOMERS AS c "
+                     "INNER JOIN (" + SQL_SELECT_KEPT_NOTES + ") AS f "
+                     "ON c.CST_ACCOUNT_NUMBER = f.CST_ACCOUNT_NUMBER")
+
+
+# Write customer state to SyrinxEH database
+def apply_customer_state(states):
+    """
+    Accepts a list of (account number, alert text, on hold, stamped) tuples
+    and writes them to Syrinx customers with a single set-based update inside
+    one transaction. An alert text of None clears the alert, an on hold of
+    None leaves the flag unchanged and stamped sets the alert change date and
+    user instead of clearing them. Returns the number of rows updated.
+    """
+
+    if DEBUG:
+        for state in states:
+            print("State to be applied: ", state)
+        return 0
+
+    if not states:
+        return 0
+
+    try:
+        import pyodbc
+    except ImportError:
+        # Only a stand-in connection, as in Benchmark, runs without pyodbc
+        pyodbc = None
+    cursor = context.cursor
+    connection = context.connection
+
+    try:
+        with RunMetrics.metrics.timer('sql_seconds', op='write'):
+            cursor.execute(SQL_CREATE_STAGING)
+            cursor.fast_executemany = True
+            if pyodbc is not None:
+                cursor.setinputsizes([(pyodbc.SQL_VARCHAR, 50, 0),
+                                      (pyodbc.SQL_WVARCHAR, 4000, 0),
+                                      (pyodbc.SQL_BIT, 0, 0),
+                                      (pyodbc.SQL_BIT, 0, 0)])
+            cursor.executemany(SQL_INSERT_STAGING, states)
+            cursor.execute(SQL_APPLY_STAGING)
+            updated = cursor.rowcount
+            cursor.execute(SQL_DROP_STAGING)
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.fast_executemany = False
+    RunMetrics.metrics.count('sql_rows_written', updated)
+
+    print(f"{len(states)} customer states staged, {updated} rows updated.")
+    return updated
+
+
+# Read flagged customers from SyrinxEH database
+def load_snapshot(cached=False):
+    """
+    Reads every flagged Syrinx customer with one query and returns them as a
+    CustomerSnapshot. The snapshot is saved to the path set in the [SNAPSHOT]
+    section of settings.ini; with cached set, that saved copy is used instead
+    of querying Syrinx, which lets dry runs work from a previous run's state.
+    """
+
+    path = config.get("SNAPSHOT", "path", fallback='')
+    if path:
+        path = os.path.join(curpath, path)
+
+    if cached and path and os.path.exists(path):
+        return SyrinxSnapshot.CustomerSnapshot.from_file(path)
+
+    cursor = context.cursor
+    with RunMetrics.metrics.timer('sql_seconds', op='read'):
+        cursor.execute(SQL_SELECT_CUSTOMERS)
+        snapshot = SyrinxSnapshot.CustomerSnapshot.from_rows(
+            cursor.fetchall())
+    RunMetrics.metrics.count('sql_rows_read', len(snapshot))
+    if path:
+        snapshot.save(path)
+
+    if DEBUG:
+        print(f"{len(snapshot)} flagged customers read from Syrinx.")
+
+    return snapshot
+
+
+# Read given customers from SyrinxEH database
+def load_accounts(accounts):
+    """
+    Reads the alert text, on hold flag and exclusion status of the given
+    Syrinx customers, whether flagged or not, and returns them as a
+    CustomerSnapshot.
+    """
+
+    cursor = context.cursor
+    with RunMetrics.metrics.timer('sql_seconds', op='read'):
+        cursor.execute(SQL_SELECT_ACCOUNTS.format(
+            ', '.join('?' * len(accounts))), *accounts)
+        snapshot = SyrinxSnapshot.CustomerSnapshot.from_rows(
+            cursor.fetchall())
+    RunMetrics.metrics.count('sql_rows_read', len(snapshot))
+    return snapshot
+
+
+# Check startup cost
+def check_startup(import_seconds):
+    """
+    Compares the time taken to import this module with budget_ms in the
+    [STARTUP] section of settings.ini, and checks that no deferred module
+    has been imported and no MYOB client or Syrinx connection created.
+    Prints the result and returns 0 if startup is within budget, otherwise
+    1, for use as an exit code.
+    """
+
+    budget = config.getfloat("STARTUP", "budget_ms", fallback=150)
+    elapsed = import_seconds * 1000
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+    created = [name for name in ('app', 'connection')
+               if getattr(context, '_' + name) is not None]
+
+    print(f"Startup: {elapsed:.0f} ms of a {budget:.0f} ms budget.")
+    if loaded:
+        print("Imported at startup: " + ", ".join(loaded))
+    if created:
+        print("Created at startup: " + ", ".join(created))
+    return 0 if elapsed <= budget and not loaded and not created else 1
+
+
+# Queue Syrinx work behind the MYOB fetch
+def syrinx_worker():
+    """
+    Returns the single background thread that Syrinx queries can be queued
+    on, so they run while MYOB is being fetched. Queued queries run one at a
+    time, in order, so the connection is never used by two at once.
+    """
+
+    global syrinx_executor
+    if syrinx_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        syrinx_executor = ThreadPoolExecutor(max_workers=1,
+                                             thread_name_prefix='syrinx')
+    return syrinx_executor
+
+
+def start_snapshot(cached=False):
+    """
+    Queues load_snapshot on the Syrinx worker and returns a Future for the
+    snapshot. get_overdue, syrinx_clear and reconcile accept the Future in
+    place of a snapshot and only wait for it once they need the customers.
+    """
+
+    return syrinx_worker().submit(load_snapshot, cached)
+
+
+def resolve_snapshot(snapshot=None):
+    """
+    Returns the given snapshot, waiting for it if it is a Future, or reads a
+    new one if none is given.
+    """
+
+    if snapshot is None:
+        return load_snapshot()
+    if hasattr(snapshot, 'result'):
+        return snapshot.result()
+    return snapshot
+
+
+# Remove automated note from Alert Note
+def kept_notes(alert_text):
+    """
+    Returns the manually entered notes kept after the '~~' marker of an
+    automated alert, or the whole alert if it has no automated note.
+    """
+
+    if alert_text is None:
+        return ''
+    pos = alert_text.find('~~')
+    if pos > 0:
+        return alert_text[pos + 3:]
+    return alert_text
+
+
+# Compare server-side clear with kept_notes()
+def check_server_clear():
+    """
+    Evaluates SQL_KEPT_NOTES against the current flagged customers without
+    writing anything and compares each result with kept_notes(). Returns a
+    list of (account number, alert text, SQL result, Python result) for every
+    customer where the two differ.
+    """
+
+    mismatches = list()
+    cursor = context.cursor
+    cursor.execute(SQL_SELECT_KEPT_NOTES)
+    for row in cursor:
+        expected = kept_notes(row[1]) or None
+        server = row[2] if row[2] else None
+        if server != expected:
+            mismatches.append((row[0], row[1], row[2], expected))
+
+    print(f"Server-side clear check: {len(mismatches)} mismatches.")
+    return mismatches
 
 
 # Clear old information from SyrinxEH database
-def syrinx_clear():
+def syrinx_clear(snapshot=None, server_side=False):
     """
-    Removes automated notes entered prior to now from Syrinx Customer Alert
+    Removes automated notes entered prior to now from Syrinx Customer Alert,
+    using the alert notes held in the snapshot. With server_side set, the
+    notes are split and written back by a single UPDATE on the server instead
+    of being read into Python.
     """
 
     if DEBUG:
         print("-------- DEBUG ON --------")
 
-    to_clear = list()
-    cursor.execute('SELECT '
-                   'CST_ACCOUNT_NUMBER, '
-                   'CST_ALERT_TEXT '
-                   'FROM SyrinxEH.dbo.TH_CUSTOMERS '
-                   'WHERE CST_CURRENT_FLAG = 1 '
-                   'AND CST_ACCOUNT_NUMBER IS NOT NULL '
-                   'AND (CST_ALERT_TEXT IS NOT NULL '
-                   'OR CST_PROP2 IS NOT NULL '
-                   'OR CST_ON_HOLD = 1)')
+    if server_side:
+        if DEBUG:
+            check_server_clear()
+            return
+        try:
+            with RunMetrics.metrics.timer('sql_seconds', op='clear'):
+                context.cursor.execute(SQL_CLEAR_FLAGGED)
+                cleared = context.cursor.rowcount
+                context.connection.commit()
+        except Exception:
+            context.connection.rollback()
+            raise
+        RunMetrics.metrics.count('sql_rows_written', cleared)
+        print(f"{cleared} rows cleared. Outdated overdue data cleared from "
+              f"Syrinx. Ready for update.")
+        return
+
+    snapshot = resolve_snapshot(snapshot)
 
     # Build list of customers to clear
-    for row in cursor:
-        if row[1] is None:
-            to_clear.append((row[0], ''))
-            continue
-        pos = row[1].find('~~')
-        if (pos > 0) and (pos != len(row[1])):
-            to_clear.append((row[0], row[1][pos + 3:(len(row[1]))]))
-        elif pos <= 0:
-            to_clear.append((row[0], row[1]))
+    to_clear = list()
+    for account, customer in snapshot.items():
+        to_clear.append((account, kept_notes(customer[0])))
 
     # Clear notes and remove on hold flag from listed customers
-    for customer in to_clear:
+    apply_customer_state([(customer[0], customer[1] or None, 0, 0)
+                          for customer in to_clear])
 
-        query = ("UPDATE SyrinxEH.dbo.TH_CUSTOMERS SET "
-                 "CST_ALERT_CHG_DATE = NULL, "
-                 "CST_ALERT_CHG_USERID = NULL, "
-                 "CST_ALERT_TEXT = "
-                 + ("NULL" if customer[1] == '' else ("'" + customer[1] + "'"))
-                 + ", "
-                 "CST_ON_HOLD = 0 "
-                 "WHERE CST_ACCOUNT_NUMBER = '" + customer[0] + "'")
+    print("Outdated overdue data cleared from Syrinx. Ready for update.")
 
-        if DEBUG:
-            print("customer, query: ", customer, query)
 
-        else:
-            cursor.execute(query)
-            connection.commit()
+# Sync local invoice mirror
+def sync_mirror(parallel=False):
+    """
+    Opens the local SQLite invoice mirror and brings it up to date with the
+    invoices changed in MYOB since the last sync, in every company file.
+    """
 
-    print("Outdated overdue data cleared from Syrinx. Ready for update.")
+    import InvoiceMirror
+    mirror = InvoiceMirror.InvoiceMirror()
+    for file_id in context.app.company_files():
+        mirror.sync(context.app, file_id, parallel=parallel)
+    return mirror
 
 
-# Get overdue information from MYOB
-def get_overdue(days_over, min_total):
+# Log a single MYOB invoice
+def log_invoice(result, logs, table, source=0):
     """
-    Gets JSON file from MYOB with invoice details and processes each line entry,
-    logging important details and accumulating a total balance for all *OVERDUE*
-    invoices.
+    Sends one invoice to the detailed logs and adds it to the invoice table
+    under the given source (company file) code.
     """
 
-    # Get JSON file and check validity
-    results = app.myob_request('overdue', min_total, days_over)
-    if not results:
-        return 'No JSON file returned.'
+    important_info = list()
+    for field in from_json:
+        if field in ['DisplayID', 'Name']:
+            important_info.append(result['Customer'][field])
+            continue
+        if field == 'Date':
+            # Reformat date from y/m/d to d/m/y
+            dt_ymd = result[field]
+            dt_dmy = f"{dt_ymd[8:10]}/{dt_ymd[5:7]}/{dt_ymd[0:4]}"
+            important_info.append(dt_dmy)
+            continue
+        important_info.append(result[field])
+    logs.add_invoice(important_info)
+    table.add(result, source)
 
-    # Create detailed log with information from individual invoices
-    log_dict_sum = dict()
-    log_dict_det = dict()
-    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    filename_det = "log_" + now + "_detailed.txt"
 
-    with open(folder_location + filename_det, 'w', newline='') \
-            as log_detailed:
-        f_write = csv.writer(log_detailed, delimiter='\t',
-                             quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        f_write.writerow(from_json)
-        for result in results:
-            important_info = list()
-            for field in from_json:
-                if field in ['DisplayID', 'Name']:
-                    important_info.append(result['Customer'][field])
-                    continue
-                if field == 'Date':
-                    # Reformat date from y/m/d to d/m/y
-                    dt_ymd = result[field]
-                    dt_dmy = f"{dt_ymd[8:10]}/{dt_ymd[5:7]}/{dt_ymd[0:4]}"
-                    important_info.append(dt_dmy)
-                    continue
-                important_info.append(result[field])
-            f_write.writerow(important_info)
-            log_dict_det[important_info[0]] = important_info[1:]
-
-            # Build dictionary with invoice information summarised by customer
-            if result['Customer']['DisplayID'] not in log_dict_sum:
-                log_dict_sum[result['Customer']['DisplayID']] = [0, 0.0, None]
-
-            log_dict_sum[result['Customer']['DisplayID']][1] += \
-                result['BalanceDueAmount']
-
-    # Query Syrinx Customers for existing notes and HoldOverdue Status
-    cursor.execute('SELECT '
-                   'CST_ACCOUNT_NUMBER, '
-                   'CST_ALERT_TEXT, '
-                   'CST_ON_HOLD, '
-                   'CASE WHEN CST_PROP2 IS NULL THEN 0 ELSE 1 END AS CST_PROP2 '
-                   'FROM SyrinxEH.dbo.TH_CUSTOMERS '
-                   'WHERE CST_CURRENT_FLAG = 1 '
-                   'AND CST_ACCOUNT_NUMBER IS NOT NULL '
-                   'AND (CST_ALERT_TEXT IS NOT NULL '
-                   'OR CST_PROP2 IS NOT NULL '
-                   'OR CST_ON_HOLD = 1)')
-
-    # Update log_dict with results from query
-    for row in cursor:
-        if row[0] not in log_dict_sum:
-            log_dict_sum[row[0]] = [row[3], 0.0, row[1]]
+# Get overdue information from MYOB
+def get_overdue(days_over, min_total, *, parallel=False, mirror=None,
+                snapshot=None, buckets=None, journal=False, replay=None,
+                sinks=None):
+    """
+    Gets overdue invoices from every MYOB company file, or from the mirror or
+    a replayed PageJournal, logging each one and totalling the balances due
+    over days_over days ago per customer, and per aging bucket if given.
+    Returns the customer summary, the InvoiceTable and the LogPipeline.
+    """
+
+    buckets = sorted(buckets) if buckets else []
+    fetch_days = min([days_over] + buckets)
+
+    # Invoices paired with the company file they came from
+    files = ['']
+    timings = dict()
+    if replay is not None:
+        invoices = (('', result) for result in replay.items())
+    elif mirror is None:
+        files = context.app.company_files()
+        invoices = context.app.iter_company_files('overdue', min_total,
+                                                  fetch_days, parallel,
+                                                  journal, files, timings)
+    else:
+        files = context.app.company_files()
+        invoices = ((file_id, result) for file_id in files
+                    for result in mirror.overdue(fetch_days, min_total,
+                                                 file_id))
+    sources = {file_id: source for source, file_id in enumerate(files)}
+
+    # Create detailed logs with information from individual invoices
+    import InvoiceTable
+    import LogPipeline
+    table = InvoiceTable.InvoiceTable()
+    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    labels = InvoiceTable.bucket_labels(buckets)
+    logs = LogPipeline.LogPipeline.from_config(now, from_json,
+                                               summary_header(labels), labels,
+                                               sinks)
+
+    # A failed fetch is raised, so it is not mistaken for no invoices
+    try:
+        for file_id, result in invoices:
+            log_invoice(result, logs, table, sources[file_id])
+    except Exception:
+        logs.abort()
+        raise
+
+    # No invoices means nobody is overdue. The flagged customers in the
+    # snapshot are still summarised, so their automated alerts are cleared.
+    if not len(table):
+        print("No overdue invoices returned.")
+
+    # Build dictionary with invoice information summarised by customer
+    table.finish()
+    if len(files) > 1:
+        log_company_files(table, files, timings, days_over, logs)
+    aged = table.aged_totals(buckets).tolist() if buckets \
+        else [[]] * len(table.customers)
+    log_dict_sum = dict()
+    for customer, total, aging in zip(table.customers,
+                                      table.overdue_totals(days_over).tolist(),
+                                      aged):
+        log_dict_sum[customer] = [0, total, None, dict(zip(labels, aging))]
+
+    # Existing notes and HoldOverdue Status of Syrinx Customers
+    snapshot = resolve_snapshot(snapshot)
+
+    # Update log_dict with the snapshot. Notes are the manually entered notes
+    # that remain once automated notes are cleared.
+    for account, customer in snapshot.items():
+        notes = kept_notes(customer[0]) or None
+        if account not in log_dict_sum:
+            log_dict_sum[account] = [customer[2], 0.0, notes,
+                                     dict.fromkeys(labels, 0.0)]
             continue
-        log_dict_sum[row[0]][0] = row[3]
-        log_dict_sum[row[0]][2] = row[1]
+        log_dict_sum[account][0] = customer[2]
+        log_dict_sum[account][2] = notes
 
     if DEBUG:
         print("log_dict_sum: ", log_dict_sum)
-        print("log_dict_det: ", log_dict_det)
+        print("Invoices per customer: ",
+              dict(zip(table.customers, table.counts().tolist())))
+        print("Oldest due date per customer: ",
+              dict(zip(table.customers, table.oldest_due().tolist())))
 
-    print("Overdue information retrieved. Details stored in file '"
-          + filename_det + "' located in folder '" + folder_location)
+    # The logs finish writing in the background while Syrinx is updated
+    for key, value in log_dict_sum.items():
+        logs.add_customer(summary_row(key, value))
+    logs.finish()
 
-    import OverdueLog
-    OverdueLog.convert_log_to_excel(log_dict_sum, log_dict_det, now)
+    print("Overdue information retrieved. Logs are being written to folder '"
+          + folder_location + "'")
 
-    return [log_dict_sum, log_dict_det]
+    return [log_dict_sum, table, logs]
 
 
-# Set overdue customers & update Alert Notes
-def set_overdue(overdue_customers, days_over):
+# Log the results of each company file
+def log_company_files(table, files, timings, days_over, logs):
     """
-    Accepts a dictionary of customers with a list of their exclusion status (a
-    Prop field in Misc tab of CRM in Syrinx), accumulated overdue balance and
-    manually entered alert notes. Constructs a new Alert Note in Syrinx, places
-    customers on hold if required and creates a log.
+    Prints and logs the invoices, customers, total overdue and fetch time
+    of each company file in a multi-file run.
     """
 
-    # For every item in given dictionary, update Syrinx with new information.
+    counts, customers, totals = table.source_totals(days_over, len(files))
+    rows = list()
+    for file_id, count, customer_count, total in zip(
+            files, counts.tolist(), customers.tolist(), totals.tolist()):
+        seconds = round(timings.get(file_id, 0.0), 2)
+        rows.append([file_id, count, customer_count, total, seconds])
+        print(f"Company file {file_id}: {count} invoices, {customer_count} "
+              f"customers, ${total:.2f} overdue, fetched in {seconds}s")
+    logs.add_company_files(['CompanyFile', 'Invoices', 'Customers',
+                            'TotalOwing', 'Seconds'], rows)
+
+
+# Build automated Alert Note
+def overdue_alert(total, days_over, notes, excluded, aging=None):
+    """
+    Returns the automated alert text for a customer owing total on invoices
+    due over days_over days ago, followed by the balance in each aging bucket
+    if given. Manually entered notes are kept after the '~~' marker.
+    """
+
+    total_owing = ("%.2f" % total)
+    days_string = str(days_over)
+    kept_notes = ((' ' + notes) if notes else '')
+    aged_balance = ''
+    if aging:
+        aged_balance = " Aged balance: " \
+                       + ", ".join(f"{label} days ${amount:.2f}"
+                                   for label, amount in aging.items()) + "."
+
+    if excluded:
+        return "OVERDUE ACCOUNT: $" + total_owing + " is the total of all " \
+               "invoices due over " + days_string + " days ago. For more " \
+               "info, see MYOB. This customer is excluded from debt " \
+               "collecting. To stop excluding this customer from debt " \
+               "collection and place this customer on hold, go to CRM, " \
+               "tick on hold and remove N from Misc > Hold Overdue. This " \
+               "message and status will disappear when the account is up " \
+               "to date." + aged_balance + " ~~" + kept_notes
+
+    return "ON HOLD DUE TO OVERDUE ACCOUNT: $" + total_owing + " to be paid " \
+           "immediately. This balance reflects the total of invoices due " \
+           "over " + days_string + " days ago. For more info, see MYOB. To " \
+           "bypass this hold, go to CRM and remove the on hold status " \
+           "temporarily. This message and status will disappear when the " \
+           "account is up to date." + aged_balance + " ~~" + kept_notes
+
+
+# Write summary log
+def summary_header(labels):
+    return [from_json[3], from_syrinx[1], 'TotalOwing', from_syrinx[0]] \
+        + list(labels)
+
+
+def summary_row(key, value):
+    return [key, value[0], value[1], value[2]] + list(value[3].values())
+
+
+def write_summary(overdue_customers):
+    """
+    Writes the per-customer exclusion status, total owing, kept alert notes
+    and aged balances to a summary log and returns its file name.
+    """
+
+    labels = list(next(iter(overdue_customers.values()), [None] * 4)[3] or [])
+
     now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
     filename_sum = "log_" + now + "_summary.txt"
 
     with open(folder_location + filename_sum, 'w', newline='') as log_summary:
         f_write = csv.writer(log_summary, delimiter='\t',
                              quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        f_write.writerow([from_json[3], from_syrinx[1], 'TotalOwing',
-                          from_syrinx[0]])
+        f_write.writerow(summary_header(labels))
         for key, value in overdue_customers.items():
-            f_write.writerow([key, value[0], value[1], value[2]])
-            if value[1] > 0:
-
-                total_owing = ("%.2f" % value[1])
-                days_string = str(days_over)
-                kept_notes = ((' ' + value[2]) if value[2] else '')
-                customer_code = str(key)
-
-                if value[0] == 1:
-
-                    query = "UPDATE SyrinxEH.dbo.TH_CUSTOMERS SET " \
-                            "CST_ALERT_CHG_DATE = GETDATE(), " \
-                            "CST_ALERT_CHG_USERID = 16, " \
-                            "CST_ALERT_TEXT = 'OVERDUE ACCOUNT: $" \
-                            + total_owing + " is the total of all invoices " \
-                            "due over " + days_string + " days ago. For more " \
-                            "info, see MYOB. This customer is excluded from " \
-                            "debt collecting. To stop excluding this " \
-                            "customer from debt collection and place this " \
-                            "customer on hold, go to CRM, tick on hold and " \
-                            "remove N from Misc > Hold Overdue. This message " \
-                            "and status will disappear when the account is " \
-                            "up to date. ~~" + kept_notes + "' " \
-                            "WHERE CST_ACCOUNT_NUMBER = '" + customer_code + "'"
-
-                elif value[0] == 0:
-                    query = "UPDATE SyrinxEH.dbo.TH_CUSTOMERS " \
-                            "SET CST_ON_HOLD = 1, " \
-                            "CST_ALERT_CHG_DATE = GETDATE(), " \
-                            "CST_ALERT_CHG_USERID = 16, " \
-                            "CST_ALERT_TEXT = 'ON HOLD DUE TO OVERDUE " \
-                            "ACCOUNT: $" + total_owing + " to be paid " \
-                            "immediately. This balance reflects the total " \
-                            "of invoices due over " + days_string + " days " \
-                            "ago. For more info, see MYOB. To bypass this " \
-                            "hold, go to CRM and remove the on hold status " \
-                            "temporarily. This message and status will " \
-                            "disappear when the account is up to date. ~~" \
-                            + kept_notes + "' " \
-                            "WHERE CST_ACCOUNT_NUMBER = '" + customer_code + "'"
-
-                if DEBUG:
-                    print("Update query to be executed: ", query)
-
-                else:
-                    cursor.execute(query)
-                    connection.commit()
-
-    connection.close()
-
-    print("Customers updated. Summary stored in '" + filename_sum
+            f_write.writerow(summary_row(key, value))
+
+    return filename_sum
+
+
+def close_logs(overdue_customers, logs=None):
+    """
+    Waits for the log pipeline from get_overdue to finish and returns the
+    names of its files. Without a pipeline, only the summary log is written.
+    """
+
+    if logs is None:
+        return [write_summary(overdue_customers)]
+    return logs.close()
+
+
+# Set overdue customers & update Alert Notes
+def set_overdue(overdue_customers, days_over, logs=None, close=True):
+    """
+    Accepts a dictionary of customers with a list of their exclusion status (a
+    Prop field in Misc tab of CRM in Syrinx), accumulated overdue balance,
+    manually entered alert notes and aged balances. Constructs a new Alert
+    Note in Syrinx, places customers on hold if required and creates a log.
+    Given the log pipeline from get_overdue, waits for it once Syrinx has been
+    updated instead of writing a summary log. With close unset, the Syrinx
+    connection is left open for the next run.
+    """
+
+    # For every item in given dictionary, update Syrinx with new information.
+    states = list()
+
+    for key, value in overdue_customers.items():
+        if value[1] > 0:
+            states.append((str(key),
+                           overdue_alert(value[1], days_over, value[2],
+                                         value[0] == 1, value[3]),
+                           None if value[0] == 1 else 1,
+                           1))
+
+    apply_customer_state(states)
+    if close:
+        context.close()
+
+    filenames = close_logs(overdue_customers, logs)
+    print("Customers updated. Logs stored in '" + "', '".join(filenames)
           + "' located in folder " + folder_location)
 
     if DEBUG:
         print("----- END OF PROGRAM -----")
+
+
+# Reconcile overdue customers with Syrinx
+def reconcile(overdue_customers, days_over, snapshot=None, logs=None,
+              close=True):
+    """
+    Accepts the same dictionary as set_overdue. Works out the alert text and
+    on hold flag each customer should have after a clear and set, compares it
+    with their current state in the snapshot and writes only the customers
+    whose state has changed. Customers are never shown as off hold part way
+    through a run. Logs and close are handled as in set_overdue.
+    """
+
+    snapshot = resolve_snapshot(snapshot)
+
+    states = list()
+    for key, value in overdue_customers.items():
+        if value[1] > 0:
+            desired = (overdue_alert(value[1], days_over, value[2],
+                                     value[0] == 1, value[3]),
+                       0 if value[0] == 1 else 1,
+                       1)
+        else:
+            desired = (value[2] or None, 0, 0)
+
+        if desired[0:2] != (snapshot.alert_text(key), snapshot.on_hold(key)):
+            states.append((str(key),) + desired)
+
+    if DEBUG:
+        print(f"{len(states)} of {len(overdue_customers)} customers changed.")
+
+    apply_customer_state(states)
+    if close:
+        context.close()
+
+    filenames = close_logs(overdue_customers, logs)
+    print("Customers reconciled. Logs stored in '" + "', '".join(filenames)
+          + "' located in folder " + folder_location)
+
+
+# Run the whole overdue cycle
+def run_cycle(days_over, min_total, buckets=None, parallel=False,
+              use_mirror=False, offline=False, journal=False,
+              changed_only=True, server_side_clear=False, close=True,
+              profile=False):
+    """
+    Reads the Syrinx snapshot, gets overdue invoices and updates Syrinx,
+    writing only changed customers (changed_only) or clearing and setting
+    every one. Offline runs read the mirror or replay the latest journal,
+    never MYOB. Each stage is timed, or profiled with profile set. Returns
+    the customer summary.
+    """
+
+    metrics = RunMetrics.metrics
+    metrics.reset()
+
+    profiler = None
+    if profile:
+        import RunProfiler
+        profiler = RunProfiler.RunProfiler()
+
+    def stage(name):
+        if profiler is None:
+            return metrics.timer('stage_seconds', stage=name)
+        return profiler.stage(name)
+
+    replay = None
+    if offline and not use_mirror:
+        # A journal holds the pages of one query, so of one company file
+        if len(context.app.company_files()) > 1:
+            raise ValueError('Offline runs replay a single page journal; '
+                             'use the mirror (use_mirror) with more than '
+                             'one company file.')
+        import PageJournal
+        replay = PageJournal.latest()
+        # Never fall back to MYOB when offline
+        if replay is None:
+            raise FileNotFoundError('No complete page journal to replay in '
+                                    + PageJournal.journal_folder())
+
+    # Flagged Syrinx customers are read once and shared by every step. The
+    # query runs in the background while MYOB is fetched; dry runs (DEBUG)
+    # reuse the snapshot saved by the last run.
+    snapshot = start_snapshot(cached=DEBUG)
+
+    mirror = None
+    if use_mirror:
+        if offline:
+            import InvoiceMirror
+            mirror = InvoiceMirror.InvoiceMirror()
+        else:
+            with stage('sync_mirror'):
+                mirror = sync_mirror(parallel)
+
+    cleared = None
+    if not changed_only and profiler is not None:
+        with stage('syrinx_clear'):
+            syrinx_clear(snapshot, server_side_clear)
+    elif not changed_only:
+        # The clear is queued behind the snapshot and runs during the fetch
+        cleared = syrinx_worker().submit(syrinx_clear, snapshot,
+                                         server_side_clear)
+
+    # Profiled runs write the Excel log as its own stage, not in the
+    # background with the other logs
+    sinks = None
+    excel = False
+    if profiler is not None:
+        import LogPipeline
+        sinks = LogPipeline.sink_names()
+        excel = 'xlsx' in sinks
+        sinks = [name for name in sinks if name != 'xlsx']
+
+    try:
+        with stage('get_overdue'):
+            overdue = get_overdue(days_over, min_total, parallel=parallel,
+                                  mirror=mirror, snapshot=snapshot,
+                                  buckets=buckets, journal=journal,
+                                  replay=replay, sinks=sinks)
+    finally:
+        # The clear ran during the fetch, so this is only the wait for it
+        with metrics.timer('stage_seconds', stage='syrinx_clear_wait'):
+            if cleared is not None:
+                cleared.result()
+        if mirror is not None:
+            mirror.close()
+
+    if changed_only:
+        with stage('reconcile'):
+            reconcile(overdue[0], days_over, snapshot, overdue[2], close)
+    else:
+        with stage('set_overdue'):
+            set_overdue(overdue[0], days_over, overdue[2], close)
+
+    if excel:
+        import OverdueLog
+        with stage('convert_log_to_excel'):
+            OverdueLog.convert_log_to_excel(
+                overdue[0], overdue[1],
+                datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"))
+    with stage('save_history'):
+        save_history(overdue, days_over)
+    finish_run(profiler)
+    return overdue[0]
+
+
+def save_history(overdue, days_over):
+    """
+    Adds the customer summary and invoices returned by get_overdue to the
+    RunStore, under the stamp of the run's logs, unless enabled is false in
+    the [HISTORY] section of settings.ini. Errors are printed, not raised.
+    """
+
+    if not config.getboolean("HISTORY", "enabled", fallback=True):
+        return
+    stamp = overdue[2].stamp \
+        or datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    try:
+        import RunStore
+        store = RunStore.RunStore()
+        try:
+            store.save(stamp, overdue[0], overdue[1], days_over)
+        finally:
+            store.close()
+    except Exception as e:
+        print(e)
+
+
+def finish_run(profiler=None):
+    """
+    Writes the metrics of the run and, for a profiled run, the profile
+    summary.
+    """
+
+    write_metrics()
+    if profiler is not None:
+        try:
+            profiler.write()
+        except Exception as e:
+            print(e)
+
+
+# Refresh selected customers
+def refresh_customers(display_ids, days_over, min_total, buckets=None,
+                      close=True):
+    """
+    Brings the overdue state of the given customers up to date without a
+    full run, e.g. to lift a hold once a customer has paid. Only their
+    invoices are fetched from each company file and only their Syrinx rows
+    read, then reconcile writes any customer whose alert or hold has
+    changed. Manually entered notes after '~~' are kept. Alerts match those
+    of a full run given the same days_over, min_total and buckets. Returns
+    the customer summary.
+    """
+
+    import InvoiceTable
+
+    display_ids = list(dict.fromkeys(display_ids))
+    buckets = sorted(buckets) if buckets else []
+    fetch_days = min([days_over] + buckets)
+
+    # The Syrinx rows are read while MYOB is fetched
+    snapshot = syrinx_worker().submit(load_accounts, display_ids)
+
+    table = InvoiceTable.InvoiceTable()
+    wanted = set(display_ids)
+    for file_id in context.app.company_files():
+        url = context.app.overdue_query(min_total, fetch_days, file_id,
+                                        display_ids)
+        for result in context.app.iter_items(url):
+            if result['Customer']['DisplayID'] in wanted:
+                table.add(result)
+    table.finish()
+
+    labels = InvoiceTable.bucket_labels(buckets)
+    totals = dict(zip(table.customers,
+                      table.overdue_totals(days_over).tolist()))
+    aged = dict(zip(table.customers, table.aged_totals(buckets).tolist())) \
+        if buckets else dict()
+    snapshot = snapshot.result()
+
+    overdue_customers = dict()
+    for display_id in display_ids:
+        overdue_customers[display_id] = [
+            snapshot.excluded(display_id) or 0,
+            totals.get(display_id, 0.0),
+            kept_notes(snapshot.alert_text(display_id)) or None,
+            dict(zip(labels, aged.get(display_id, [0.0] * len(labels))))]
+        print(f"{display_id}: ${overdue_customers[display_id][1]:.2f} due "
+              f"over {days_over} days ago.")
+
+    reconcile(overdue_customers, days_over, snapshot, close=close)
+    return overdue_customers
+
+
+def write_metrics():
+    """
+    Writes the metrics of the run, printing rather than raising any error so
+    a finished run is never failed by its report.
+    """
+
+    now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    try:
+        filename = RunMetrics.metrics.write(now)
+        print("Run metrics stored in '" + filename + "' located in folder "
+              + folder_location)
+    except Exception as e:
+        print(e)
@@ -0,0 +1,15 @@
+import configparser
+import os
+import sys
+
+# settings.ini, read once from beside the script that was run and shared by
+# every module:
+# > import Settings
+# > config = Settings.config
+# > Settings saved with MyobAuth.save_config(config, cfgpath) keep every
+#   section, as all modules hold the same ConfigParser
+
+curpath = os.path.dirname(os.path.realpath(sys.argv[0]))
+cfgpath = os.path.join(curpath, 'settings.ini')
+config = configparser.ConfigParser()
+config.read(cfgpath)
@@ -0,0 +1,56 @@
+import json
+
+DEBUG = False
+MSG_PREFIX = 'Message from SyrinxSnapshot >> '
+
+
+class CustomerSnapshot:
+    """
+    Flagged Syrinx customers read with a single query, indexed by account
+    number. Each customer holds their alert text, on hold flag and exclusion
+    (HoldOverdue) flag as they were when the snapshot was taken.
+    """
+
+    def __init__(self, customers=None):
+        self.customers = customers if customers is not None else dict()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds a snapshot from (account number, alert text, on hold, excluded)
+        rows such as those returned by SetOverdue.SQL_SELECT_CUSTOMERS.
+        """
+        customers = dict()
+        for row in rows:
+            customers[row[0]] = (row[1], row[2] or 0, row[3])
+        return cls(customers)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as file:
+            customers = json.load(file)
+        if DEBUG:
+            print(MSG_PREFIX + f'{len(customers)} customers read from {path}')
+        return cls({key: tuple(value) for key, value in customers.items()})
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.customers, file)
+
+    def alert_text(self, account):
+        return self.customers.get(account, (None, 0, 0))[0]
+
+    def on_hold(self, account):
+        return self.customers.get(account, (None, 0, 0))[1]
+
+    def excluded(self, account):
+        return self.customers.get(account, (None, 0, 0))[2]
+
+    def items(self):
+        return self.customers.items()
+
+    def __contains__(self, account):
+        return account in self.customers
+
+    def __len__(self):
+        return len(self.customers)
@@ -2,11 +2,70 @@
 
 __author__ = 'Jade McKenzie', 'Tyler McCamley'
 
+import argparse
+import sys
+import time
+
+started = time.perf_counter()
 import SetOverdue as Go
+import_time = time.perf_counter() - started
 
 DAYS_OVER = 60
 MIN_TOTAL = 0.0
+# Aging buckets (days overdue) reported alongside the DAYS_OVER total. All
+# buckets come from a single MYOB fetch.
+AGING_BUCKETS = [30, 60, 90, 120]
+PARALLEL_PAGES = True
+# Answer the overdue query from the local invoice mirror, syncing it first
+# unless running offline.
+USE_MIRROR = False
+OFFLINE = False
+# Journal MYOB pages to disk so an interrupted fetch resumes where it stopped.
+# Offline runs without the mirror replay the latest complete journal.
+JOURNAL_PAGES = True
+# Write only customers whose alert or hold has changed instead of clearing
+# every flagged customer and setting them again.
+RECONCILE = True
+# When clearing, split the alert notes on the server instead of in Python.
+SERVER_SIDE_CLEAR = True
+
+# Settings for each overdue run
+CYCLE = {'days_over': DAYS_OVER,
+         'min_total': MIN_TOTAL,
+         'buckets': AGING_BUCKETS,
+         'parallel': PARALLEL_PAGES,
+         'use_mirror': USE_MIRROR,
+         'offline': OFFLINE,
+         'journal': JOURNAL_PAGES,
+         'changed_only': RECONCILE,
+         'server_side_clear': SERVER_SIDE_CLEAR}
+
+parser = argparse.ArgumentParser(
+    description='Flags customers with overdue MYOB invoices in Syrinx.')
+parser.add_argument('--check-startup', action='store_true',
+                    help='report startup time against the [STARTUP] budget '
+                         'and exit, non-zero if over budget')
+parser.add_argument('--service', action='store_true',
+                    help='stay resident and run on the [SERVICE] schedule, '
+                         'with a local health endpoint')
+parser.add_argument('--profile', action='store_true',
+                    help='profile each stage, saving .pstats and collapsed '
+                         'stack files next to the logs')
+parser.add_argument('--refresh', nargs='+', metavar='DISPLAY_ID',
+                    help='refresh only the given customers, e.g. once they '
+                         'have paid, and exit')
+args = parser.parse_args()
+
+if args.check_startup:
+    sys.exit(Go.check_startup(import_time))
+
+if args.refresh:
+    Go.refresh_customers(args.refresh, DAYS_OVER, MIN_TOTAL, AGING_BUCKETS)
+    sys.exit(0)
 
-Go.syrinx_clear()
-overdue = Go.get_overdue(DAYS_OVER, MIN_TOTAL)
-Go.set_overdue(overdue[0], DAYS_OVER)
+cycle = dict(CYCLE, profile=args.profile)
+if args.service:
+    import OverdueService
+    OverdueService.OverdueService(cycle).serve()
+else:
+    Go.run_cycle(**cycle)
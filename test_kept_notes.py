@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+# Settings reads settings.ini from beside the script that was run
+sys.argv[0] = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           'main.py')
+
+import Benchmark
+import SetOverdue
+
+# Each alert text in Benchmark.KEPT_NOTES_CASES and the alert left after its
+# automated note is cleared (None when nothing is kept)
+EXPECTED = {'ON HOLD ~~ Call before delivery': 'Call before delivery',
+            '~~ note': '~~ note',
+            '~~': '~~',
+            'ON HOLD ~~': None,
+            'ON HOLD ~~ ': None,
+            'ON HOLD ~~ note  ': 'note  ',
+            'ON HOLD ~~    ': '   ',
+            'ON HOLD ~~note': 'ote',
+            'A~~B': None,
+            'ON HOLD ~~ one ~~ two': 'one ~~ two',
+            ' ~~ note': 'note',
+            'Deliver to back door': 'Deliver to back door',
+            'Deliver to back door  ': 'Deliver to back door  ',
+            '~': '~',
+            '': None,
+            None: None}
+
+
+class KeptNotesTest(unittest.TestCase):
+
+    def test_cases_covered(self):
+        self.assertEqual(sorted(EXPECTED, key=repr),
+                         sorted(Benchmark.KEPT_NOTES_CASES, key=repr))
+
+    def test_kept_notes(self):
+        for text, expected in EXPECTED.items():
+            with self.subTest(text=text):
+                self.assertEqual(SetOverdue.kept_notes(text) or None,
+                                 expected)
+
+    def test_server_side_clear(self):
+        self.assertEqual(Benchmark.check_kept_notes(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# Imports SetOverdue as main.py does and prints the import time in ms,
+# the budget and any deferred module already loaded, one per line
+STARTUP_SCRIPT = '''
+import sys
+import time
+sys.argv[0] = "main.py"
+started = time.perf_counter()
+import SetOverdue
+elapsed = (time.perf_counter() - started) * 1000
+print(elapsed)
+print(SetOverdue.config.getfloat("STARTUP", "budget_ms", fallback=150))
+for name in SetOverdue.DEFERRED_MODULES:
+    if name in sys.modules:
+        print(name)
+'''
+
+
+class StartupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        folder = os.path.dirname(os.path.realpath(__file__))
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT],
+                                cwd=folder, capture_output=True, text=True,
+                                check=True)
+        lines = result.stdout.split()
+        cls.elapsed = float(lines[0])
+        cls.budget = float(lines[1])
+        cls.loaded = lines[2:]
+
+    def test_import_within_budget(self):
+        self.assertLessEqual(self.elapsed, self.budget)
+
+    def test_no_deferred_modules(self):
+        self.assertEqual(self.loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()